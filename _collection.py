@@ -2,6 +2,11 @@
 
 from collections import OrderedDict
 
+try:
+    from collections.abc import ItemsView, KeysView, Mapping, ValuesView
+except ImportError:  # python2
+    from collections import ItemsView, KeysView, Mapping, ValuesView
+
 empty = object()
 
 
@@ -20,24 +25,52 @@ class NoEmptyDict(dict):
 class NullDict(dict):
     """
     如果设置了None值作为value, 则自动转化为'null', 方便格式化sql使用
+    >>> NullDict({"a": None}, b=1) == {"a": "null", "b": 1}
+    True
     """
+    def __init__(self, *args, **kwargs):
+        super(NullDict, self).__init__()
+        self.update(*args, **kwargs)
+
     def __setitem__(self, key, value):
         if value is None:
             value = "null"
 
         return super(NullDict, self).__setitem__(key, value)
 
-    def update(self, __m, **kwargs):
-        pass
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        if len(args) > 1:
+            raise TypeError("update expected at most 1 arguments, got {}".format(len(args)))
+        if args:
+            other = args[0]
+            pairs = other.items() if hasattr(other, "keys") else other
+            for key, value in pairs:
+                self[key] = value
+        for key, value in kwargs.items():
+            self[key] = value
 
 
 class MappingList(list):
     """拥有字典的特性, 但是可以被序列化成列表, 方便数据format;
-       mapping list 将无法删除数据,因为列表元素变化则字典内的地址全部混乱
+       删除时只把对应的位置标记为empty(墓碑), 墓碑超过一半时再压缩, 删除的均摊复杂度为O(1);
+       迭代(json序列化, list())会跳过墓碑, 下标访问, 比较, repr 等直接使用列表存储的操作会先压缩;
+       值不能是empty
     """
+    __slots__ = ("_map", "_keys", "_trash", "_dead")
+
+    # 墓碑数量超过这个值并且超过存储的一半时压缩
+    compact_threshold = 16
+
     def __init__(self, *args, **kwargs):
-        self._map = OrderedDict()  # _map的value永远是数字, 代表着真正值在self中的index
+        self._map = dict()  # _map的value永远是数字, 代表着真正值在self中的index
+        self._keys = list()  # 和self一一对应的key, 被删除的位置为empty
         self._trash = empty
+        self._dead = 0
         if args:
             raise Exception("The Mapping list only accept keyword args")
         super(MappingList, self).__init__()
@@ -48,13 +81,41 @@ class MappingList(list):
     def setdefault(self, key, default):
         try:
             index = self._map[key]
-            return self[index]
+            return list.__getitem__(self, index)
         except KeyError:
             self.key_append(key, default)
             return default
 
+    def __iter__(self):
+        if not self._dead:
+            return list.__iter__(self)
+        return (value for value in list.__iter__(self) if value is not empty)
+
+    def __len__(self):
+        return len(self._map)
+
+    def _iter_keys(self):
+        if not self._dead:
+            return iter(self._keys)
+        return (key for key in self._keys if key is not empty)
+
+    def _iter_items(self):
+        if not self._dead:
+            return zip(self._keys, list.__iter__(self))
+        return ((key, value) for key, value in zip(self._keys, list.__iter__(self)) if key is not empty)
+
+    def as_mapping(self):
+        """只读的字典视图, 不复制数据, MappingList的变化会立即反映出来"""
+        return MappingListProxy(self)
+
+    def keys(self):
+        return self.as_mapping().keys()
+
+    def values(self):
+        return self.as_mapping().values()
+
     def items(self):
-        return zip(self._map.keys(), self)
+        return self.as_mapping().items()
 
     def trash_setdefault(self, key, default, trash_flag=None):
         """如果Key是Trash_Flag, 设置Trash并返回, 否则调用setdefault
@@ -68,7 +129,7 @@ class MappingList(list):
 
     def get(self, key, default=None):
         try:
-            return self[self._map[key]]
+            return list.__getitem__(self, self._map[key])
         except KeyError:
             return default
 
@@ -76,7 +137,7 @@ class MappingList(list):
         """
         raise keyError when the key don't exit
         """
-        return self[self._map[key]]
+        return list.__getitem__(self, self._map[key])
 
     def key_append(self, key, value):
         """append when key does't exist;
@@ -84,17 +145,46 @@ class MappingList(list):
         """
         try:
             index = self._map[key]
-            self[index] = value
+            list.__setitem__(self, index, value)
         except KeyError:
             # call list append to append
             super(MappingList, self).append(value)
-            self._map[key] = self.__len__() - 1
+            self._keys.append(key)
+            self._map[key] = len(self._keys) - 1
+
+    def key_pop(self, key, default=empty):
+        """删除key并返回对应的值, key不存在时返回default, 没有default则raise KeyError"""
+        try:
+            index = self._map.pop(key)
+        except KeyError:
+            if default is empty:
+                raise
+            return default
+        value = list.__getitem__(self, index)
+        if index == len(self._keys) - 1:
+            super(MappingList, self).pop()
+            self._keys.pop()
+        else:
+            list.__setitem__(self, index, empty)
+            self._keys[index] = empty
+            self._dead += 1
+            if self._dead > self.compact_threshold and self._dead * 2 > len(self._keys):
+                self._compact()
+        return value
+
+    def _compact(self):
+        """去掉所有的墓碑, 重建下标"""
+        if not self._dead:
+            return
+        items = [(key, value) for key, value in self._iter_items()]
+        self._keys = [key for key, _ in items]
+        list.__setitem__(self, slice(None), [value for _, value in items])
+        self._map = dict((key, index) for index, key in enumerate(self._keys))
+        self._dead = 0
 
     def to_dict(self):
-        """change to dict"""
-        if len(self._map) != len(self):
-            raise Exception("The mapping has been changed")
-        return OrderedDict(zip(self._map.keys(), self))
+        """change to dict, 不需要复制时使用 as_mapping"""
+        return OrderedDict(self._iter_items())
 
     def append(self, obj):
         raise Exception("Use .key_append() to set a key-value")
@@ -110,25 +200,131 @@ class MappingList(list):
 
     def popitem(self):
         """pop the last element"""
-        ele = super(MappingList, self).pop()
-        self._map.popitem(last=True)
-        return ele
+        if not self._map:
+            raise KeyError("popitem(): MappingList is empty")
+        while self._keys[-1] is empty:
+            super(MappingList, self).pop()
+            self._keys.pop()
+            self._dead -= 1
+        return self.key_pop(self._keys[-1])
 
-    def insert(self, index, p_object):
-        raise Exception("Use .key_append() to set a key-value")
-
-    def pop(self, *indexes):
-        raise Exception("MappingList can't been change")
+    def pop(self, index=-1):
+        """按照下标删除"""
+        self._compact()
+        return self.key_pop(self._keys[index])
 
     def remove(self, value):
+        """删除第一个等于value的元素"""
+        for key, item in self._iter_items():
+            if item == value:
+                self.key_pop(key)
+                return
+        raise ValueError("MappingList.remove(x): x not in MappingList")
+
+    def __delitem__(self, index):
+        raise Exception("Use .key_pop() to delete a key-value")
+
+    def __iadd__(self, other):
+        raise Exception("Use .update() to merge a key-value")
+
+    def __imul__(self, n):
         raise Exception("MappingList can't been change")
 
+    def clear(self):
+        list.__delitem__(self, slice(None))
+        self._map.clear()
+        del self._keys[:]
+        self._dead = 0
+
+    def insert(self, index, p_object):
+        raise Exception("Use .key_append() to set a key-value")
+
     def reverse(self):
         raise Exception("MappingList can't been change")
 
     def sort(self, cmp=None, key=None, reverse=False):
         raise Exception("MappingList can't been change")
 
+    def __reduce__(self):
+        return _rebuild_mapping_list, (self.__class__, list(self._iter_items()), self._trash)
+
+
+def _rebuild_mapping_list(cls, items, trash):
+    res = cls()
+    for key, value in items:
+        res.key_append(key, value)
+    res._trash = trash
+    return res
+
+
+def _compacted(name):
+    """直接读取列表存储的方法, 调用之前先去掉墓碑"""
+    method = getattr(list, name)
+
+    def wrapper(self, *args):
+        if self._dead:
+            self._compact()
+        return method(self, *args)
+
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+for _name in ("__getitem__", "__setitem__", "__getslice__", "__setslice__", "__contains__", "__reversed__",
+              "__repr__", "__eq__", "__ne__", "__lt__", "__le__", "__gt__", "__ge__", "__add__", "__mul__",
+              "__rmul__", "count", "index", "copy"):
+    if hasattr(list, _name):
+        setattr(MappingList, _name, _compacted(_name))
+
+
+class MappingListProxy(Mapping):
+    """
+    MappingList 的只读字典视图, 不复制数据
+    >>> a = MappingList(a=1)
+    >>> a.key_append("b", 2)
+    >>> view = a.as_mapping()
+    >>> a.key_pop("a")
+    1
+    >>> dict(view), list(a.items()), a
+    ({'b': 2}, [('b', 2)], [2])
+    """
+    __slots__ = ("_list",)
+
+    def __init__(self, mapping_list):
+        self._list = mapping_list
+
+    def __getitem__(self, key):
+        return self._list.force_get(key)
+
+    def __iter__(self):
+        return self._list._iter_keys()
+
+    def __len__(self):
+        return len(self._list)
+
+    def __contains__(self, key):
+        return key in self._list._map
+
+    def keys(self):
+        return KeysView(self)
+
+    def values(self):
+        return _ValuesView(self)
+
+    def items(self):
+        return _ItemsView(self)
+
+
+class _ValuesView(ValuesView):
+    def __iter__(self):
+        return iter(self._mapping._list)
+
+
+class _ItemsView(ItemsView):
+    def __iter__(self):
+        return self._mapping._list._iter_items()
+
 
 if __name__ == '__main__':
     a = MappingList(a=1, b=2)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+订单切割者的asyncio接口
+
+从异步数据源(消息队列的消费者, 异步的数据库游标等)读取订单, 到达之后立即路由到粒度,
+读取和计算之间使用有界的 asyncio.Queue, 计算跟不上时暂停读取; 谓词的计算放在executor中, 不会阻塞事件循环
+
+    splitter = AsyncOrderSplitter(Dimension("order_type"), granularities)
+    async for dim_info, gra, rows in splitter.aiter_split(cursor):
+        ...
+    async for order, gra in splitter.aapply_to(consumer):
+        ...
+"""
+import asyncio
+import copy
+from functools import partial
+
+from order_splitter import IncrementalOrderSplitter
+
+_END = object()
+
+
+class _Failure(object):
+    """数据源抛出的异常, 交给消费者重新抛出"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+async def _iter_source(source):
+    if hasattr(source, "__aiter__"):
+        async for row in source:
+            yield row
+    else:
+        for row in source:
+            yield row
+
+
+async def _produce(source, queue, batch_size):
+    """按照 batch_size 读取数据源放入队列, 队列满时等待"""
+    try:
+        batch = list()
+        async for row in _iter_source(source):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                await queue.put(batch)
+                batch = list()
+        if batch:
+            await queue.put(batch)
+        await queue.put(_END)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        await queue.put(_Failure(e))
+
+
+async def _iter_batches(source, batch_size, max_pending):
+    """
+    后台任务读取数据源, 最多缓存 max_pending 批数据
+    :return: async generator list
+    """
+    if batch_size < 1 or max_pending < 1:
+        raise ValueError(u"batch_size 和 max_pending 至少为1")
+    queue = asyncio.Queue(max_pending)
+    producer = asyncio.ensure_future(_produce(source, queue, batch_size))
+    try:
+        while True:
+            batch = await queue.get()
+            if batch is _END:
+                break
+            if isinstance(batch, _Failure):
+                raise batch.error
+            yield batch
+    finally:
+        producer.cancel()
+
+
+class AsyncOrderSplitter(IncrementalOrderSplitter):
+    """
+    异步拆单, 参数和 OrderSplitter 一致
+    每一批数据通过 add_batch 在executor中路由, 同一时间只有一批数据在计算, 因此executor应该是线程池(None 使用事件循环默认的线程池)
+    """
+
+    async def _run(self, executor, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, partial(func, *args))
+
+    def _call_state(self):
+        """
+        每次调用使用独立的分组, 数据源出错或者提前停止迭代的调用不会把剩下的行留给之后的调用
+        (提前停止的异步生成器由事件循环稍后关闭, 在finally中清空共享的分组可能清空之后的调用)
+        """
+        splitter = copy.copy(self)
+        splitter.reset()
+        return splitter
+
+    async def aiter_split(self, source, batch_size=1000, max_pending=4, executor=None, clustered=False):
+        """
+        异步的 iter_split
+        :param source: 异步可迭代对象, 也可以是普通的可迭代对象
+        :param batch_size: 每次路由的行数
+        :param max_pending: 队列中最多等待的批数, 达到之后暂停读取数据源
+        :param executor: 计算谓词的executor
+        :param clustered: 数据源中相同维度的数据是连续的(比如按照维度排序的游标), 维度变化之后立即输出之前的分组,
+               否则数据源结束之后才输出所有的分组
+        :return: async generator ( dimensions_info: namedtuple, Granularity: BaseCondition, rows: list )
+        """
+        splitter = self._call_state()
+        key_of = splitter._key_function()
+        async for batch in _iter_batches(source, batch_size, max_pending):
+            await self._run(executor, splitter.add_batch, batch)
+            if not clustered:
+                continue
+            current = key_of(batch[-1])
+            for key in splitter.group_keys():
+                if key != current:
+                    for res in splitter.pop_group(key):
+                        yield res
+
+        for res in list(splitter.iter_buckets()):
+            yield res
+
+    async def aapply_to(self, source, batch_size=100, max_pending=4, executor=None, full=False):
+        """
+        异步的 apply_to / full_apply_to
+        :param full: True 时返回每行匹配的所有粒度
+        :return: async generator ( row, Granularity or None ), full 时为 ( row, [Granularity, ..] )
+        """
+        if full:
+            def apply(batch):
+                return [(row, list(self.full_apply_to(row))) for row in batch]
+        else:
+            def apply(batch):
+                return [(row, self.apply_to(row)) for row in batch]
+
+        async for batch in _iter_batches(source, batch_size, max_pending):
+            for res in await self._run(executor, apply, batch):
+                yield res
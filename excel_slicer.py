@@ -1,51 +1,292 @@
 # AUTHOR ZinkLu
 # DATE 2019-12-24
+import abc
+import codecs
+import copy
+import csv
+import io
+import json
 import os
+import queue
+import pickle
+import re
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, count, islice, zip_longest
 
 from openpyxl import Workbook, load_workbook
 from typing import List, AnyStr
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # parquet格式需要pyarrow
+    pyarrow = None
+
+try:
+    import pandas
+except ImportError:  # dataframe格式的batch_processor需要pandas
+    pandas = None
+
+# 文件后缀: 格式
+FORMATS = {"xlsx": "xlsx", "xlsm": "xlsx", "csv": "csv", "parquet": "parquet", "pq": "parquet"}
+
+
+def _format_of(path) -> str:
+    extension = os.path.splitext(path)[-1].lstrip(".").lower()
+    try:
+        return FORMATS[extension]
+    except KeyError:
+        raise ValueError(f"不支持的文件格式: {path}")
+
+
+def _require_pyarrow():
+    if pyarrow is None:
+        raise ImportError("parquet格式需要安装pyarrow")
+    return pyarrow
+
 
 class ExcelSlicer:
 
-    def __init__(self, path, pace, save_to="", processor=None):
+    def __init__(self, path, pace, save_to="", processor=None, streaming=False,
+                 input_format=None, output_format=None, encoding="utf-8-sig",
+                 batch_processor=None, chunk_size=1000, batch_format="rows", checkpoint=None):
+        """
+        :param processor: 处理每一行, function(list) -> list, 逐行处理, 不会预读
+        :param streaming: 流式模式, 只读取单元格的值, 使用 write_only 的工作簿边写边落盘, 内存占用和 pace 无关
+        :param input_format: enum[xlsx, csv, parquet] 不传则根据文件后缀判断
+        :param output_format: enum[xlsx, csv, parquet] 不传则和输入的格式一致;
+               csv切分为csv并且没有processor和batch_processor时, 直接按照记录复制原始的行, 不解析单元格
+        :param encoding: csv的编码
+        :param batch_processor: 处理每 chunk_size 行, 接收并返回 batch_format 格式的数据块, 和 processor 只能传一个
+        :param chunk_size: batch_processor 每次最多处理的行数, 数据块不会跨越切片
+        :param batch_format: enum[rows, columns, dataframe]
+            - rows: [[值, ..], ..]
+            - columns: {表头: [值, ..]}, 超出表头的列使用下标作为key, 返回的列可以是list或者numpy数组, 按照字典的顺序写入
+            - dataframe: pandas.DataFrame, 列名为表头, 缺失值(NaN)写入时为空
+        :param checkpoint: 断点文件(json)的路径, True 时为 save_to 中的 "<文件名>.slices.json";
+               记录已经完成的切片以及每个切片在数据源中的位置, 重新执行 slice_it 时直接跳到第一个没有完成的切片,
+               要求 processor / batch_processor 不改变行数
+        """
         self.path = path
         self.pace = pace
         self.save_to = save_to
         self.cursor = 0
+        self.streaming = streaming
+        self.input_format = input_format or _format_of(path)
+        self.output_format = output_format or self.input_format
+        for file_format in (self.input_format, self.output_format):
+            if file_format not in WRITERS:
+                raise ValueError(f"不支持的文件格式: {file_format}")
+        self.encoding = encoding
+        self._source = None  # csv的文件对象
 
-        self.template_workbook = self._get_read_only_template()
-        self.template_sheet = self.template_workbook.active
+        self.template_workbook = None
+        self.template_sheet = None
         self.template_name = os.path.split(path)[-1].split(".")[0]
-        self.template_head = self._get_template_head()
+        if self.input_format == "xlsx":
+            self.template_workbook = self._get_read_only_template()
+            self.template_sheet = self.template_workbook.active
+            self.template_title = self.template_sheet.title
+        else:
+            self.template_title = self.template_name
 
-        self.rows = self.template_sheet.rows
+        self.rows = self._iter_rows()
         self.processor = processor
-        next(self.rows)  # 数据去头
+        self.template_head = self._get_template_head()  # 数据去头
+
+        if processor is not None and batch_processor is not None:
+            raise ValueError("processor 和 batch_processor 只能传一个")
+        if batch_format not in BATCH_FORMATS:
+            raise ValueError(f"不支持的数据块格式: {batch_format}")
+        if chunk_size < 1:
+            raise ValueError("chunk_size 至少为1")
+        if batch_format == "columns" and len(set(self.template_head)) != len(self.template_head):
+            raise ValueError("表头有重复的列, 不能使用 columns 格式")
+        if batch_format == "dataframe" and pandas is None:
+            raise ImportError("dataframe格式需要安装pandas")
+        self.batch_processor = batch_processor
+        self.chunk_size = chunk_size
+        self.batch_format = batch_format
+        self._values = None
+
+        self.index = None  # SliceIndex
+        if checkpoint:
+            if checkpoint is True:
+                checkpoint = os.path.join(save_to, f"{self.template_name}.slices.json")
+            self.index = self._open_index(checkpoint)
 
     def _get_read_only_template(self) -> Workbook:
         template = load_workbook(self.path, read_only=True)
         return template
 
     def _get_template_head(self) -> List[AnyStr]:
-        head = next(self.template_sheet.rows)
-        return [h.value for h in head]
+        return self._row_values(next(self.rows))
+
+    def _iter_rows(self):
+        if self.input_format == "csv":
+            self._source = open(self.path, newline="", encoding=self.encoding)
+            return csv.reader(self._source)
+        if self.input_format == "parquet":
+            return _iter_parquet_rows(self.path)
+        if self.streaming:
+            return self.template_sheet.iter_rows(values_only=True)
+        return self.template_sheet.rows
+
+    def _row_values(self, row) -> list:
+        if self.input_format == "xlsx" and not self.streaming:
+            return [r.value for r in row]
+        return row if type(row) is list else list(row)
+
+    def _iter_positioned_rows(self, position, parse=True):
+        """
+        从 position 开始读取数据源
+        :param position: csv为字节偏移, 其他格式为行号(表头为第0行)
+        :param parse: False 时只计算位置, 不返回行的内容
+        :return: generator (行, 下一行的位置)
+        """
+        if self.input_format == "csv":
+            yield from _iter_csv_rows(self.path, self.encoding, position, parse)
+            return
+        if self.input_format == "parquet":
+            rows = _iter_parquet_rows(self.path, start=position)
+        else:
+            rows = _iter_sheet_rows(self.template_sheet, position + 1, self.streaming or not parse)
+        yield from zip(rows, count(position + 1))
+
+    def _source_signature(self) -> dict:
+        """数据源或者切片大小变化之后, 之前的索引失效"""
+        stat = os.stat(self.path)
+        return {"format": self.input_format, "encoding": self.encoding if self.input_format == "csv" else None,
+                "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "pace": self.pace}
+
+    def _open_index(self, path):
+        """
+        :param path: 断点文件的路径, None 时只在内存中
+        :rtype SliceIndex
+        """
+        index = SliceIndex.load(path, self._source_signature())
+        if not index.positions:
+            rows = self._iter_positioned_rows(0, parse=False)
+            try:
+                index.record(0, next(rows)[1])  # 第一个切片从表头之后开始
+            finally:
+                rows.close()
+        return index
+
+    def _scan_to(self, n) -> bool:
+        """
+        确保索引中有第n个切片的位置, 从已知的最后一个位置开始扫描, 不经过 processor
+        :param n: None 时扫描到数据源结束
+        :return: 第n个切片是否存在
+        """
+        index = self.index
+        known = len(index.positions) - 1
+        if n is not None and n <= known:
+            return True
+        if index.total is None and n is not None and self.input_format != "csv":
+            # 行号可以直接计算, 只需要确认第n个切片之前的一行存在
+            position = index.positions[0] + n * self.pace
+            rows = self._iter_positioned_rows(position - 1, parse=False)
+            try:
+                exists = next(rows, None) is not None
+            finally:
+                rows.close()
+            if exists:
+                for k in range(known + 1, n + 1):
+                    index.record(k, index.positions[0] + k * self.pace)
+                return True
+        if index.total is None:
+            rows = self._iter_positioned_rows(index.positions[known], parse=False)
+            try:
+                for i, (_, position) in enumerate(rows, 1):
+                    if i % self.pace == 0:
+                        known += 1
+                        index.record(known, position)
+                        if known == n:
+                            return True
+            finally:
+                rows.close()
+            index.total = known + 1
+        return False
+
+    def _indexed_rows(self, n):
+        """从第n个切片开始读取, 每 pace 行在索引中记录下一个切片的位置"""
+        rows = self._iter_positioned_rows(self.index.positions[n])
+        try:
+            for i, (row, position) in enumerate(rows, 1):
+                if i % self.pace == 0:
+                    self.index.record(n + i // self.pace, position)
+                yield row
+        finally:
+            rows.close()
+        self.index.total = len(self.index.positions)
+
+    def seek_slice(self, n) -> bool:
+        """
+        跳到第n个切片的开头, 之前的行不经过 processor; 索引中没有这个位置时从最近的已知位置开始扫描
+        :return: 第n个切片是否存在
+        """
+        if self.index is None:
+            self.index = self._open_index(None)
+        if not self._scan_to(n):
+            return False
+        if self._source is not None:
+            self._source.close()
+        self.rows = self._source = self._indexed_rows(n)
+        self._values = None
+        self.cursor = n * self.pace
+        return True
+
+    def build_index(self):
+        """
+        扫描整个数据源, 记录每个切片的位置并保存, 之后可以直接跳到任意切片
+        :rtype SliceIndex
+        """
+        if self.index is None:
+            self.index = self._open_index(None)
+        self._scan_to(None)
+        self.index.save()
+        return self.index
 
     def make_template_workbook(self) -> Workbook:
-        wb = Workbook()
-        sheet = wb.active
-        sheet.title = self.template_sheet.title
-        sheet.append(self.template_head)
-        return wb
+        return _template_workbook(self.template_title, self.template_head, self.streaming)
+
+    def make_writer(self, file_path):
+        """
+        :rtype SliceWriter
+        """
+        if self.output_format == "xlsx":
+            return XlsxSliceWriter(file_path, workbook=self.make_template_workbook())
+        return WRITERS[self.output_format](file_path, self.template_title, self.template_head,
+                                          **self._writer_options())
+
+    def _writer_options(self) -> dict:
+        if self.output_format == "csv":
+            return {"encoding": self.encoding}
+        if self.output_format == "xlsx":
+            return {"write_only": True}
+        return {}
+
+    def close(self):
+        """关闭读取的文件"""
+        if self.template_workbook is not None:
+            self.template_workbook.close()
+        if self._source is not None:
+            self._source.close()
 
     def pace_loopper(self, workbook: Workbook):
-        sheet = workbook.active
+        """
+        :param workbook: make_template_workbook 或者 make_writer 的返回值
+        """
+        sheet = workbook if isinstance(workbook, SliceWriter) else workbook.worksheets[0]
+        values = self.iter_values()
         for _ in range(self.cursor, self.cursor + self.pace):
             try:
-                row = next(self.rows)
-                value = [r.value for r in row]
-                if self.processor is not None:
-                    value = self.processor(value)
+                value = next(values)
                 # value[0] = value[1]
                 sheet.append(value)
             except StopIteration as e:
@@ -55,18 +296,817 @@ class ExcelSlicer:
         self.cursor += self.pace
         return workbook
 
-    def slice_it(self):
-        n = 0
+    def iter_values(self):
+        """经过 processor / batch_processor 处理之后的每一行, 多次调用返回同一个迭代器"""
+        if self._values is None:
+            self._values = self._process_values(self.cursor)
+        return self._values
+
+    def _process_values(self, position):
+        values = (self._row_values(row) for row in self.rows)
+        if self.processor is not None:
+            # 逐行处理, 不预读, processor 出错时之前的切片都已经写完
+            yield from map(self.processor, values)
+            return
+        if self.batch_processor is None:
+            yield from values
+            return
+        to_block, from_block = BATCH_FORMATS[self.batch_format]
         while True:
-            workbook = self.make_template_workbook()
-            file_path = os.path.join(self.save_to, "会员信息创建" + self.template_name+f"_{n}.xlsx")
+            # 数据块不跨越切片, batch_processor 出错时之前的切片都已经写完
+            rows = list(islice(values, min(self.chunk_size, self.pace - position % self.pace)))
+            if not rows:
+                return
+            position += len(rows)
+            processed = from_block(self.batch_processor(to_block(rows, self.template_head)), self.template_head)
+            if self.index is not None:
+                # 索引中的位置是数据源的行, 输出的行必须和数据源一一对应
+                processed = list(processed)
+                if len(processed) != len(rows):
+                    raise ValueError("使用切片索引时 batch_processor 返回的行数必须和输入一致")
+            yield from processed
+
+    def slice_path(self, n) -> str:
+        extension = WRITERS[self.output_format].extension
+        return os.path.join(self.save_to, "会员信息创建" + self.template_name+f"_{n}.{extension}")
+
+    def slice_it(self):
+        """使用 checkpoint 时从第一个没有完成的切片开始"""
+        self._write_slices(0 if self.index is None else self.index.completed)
+
+    def slice_range(self, start, stop=None):
+        """
+        只生成第 start 到 stop - 1 个切片, 文件名和 slice_it 一致, 通过索引跳过之前的行
+        读取到数据源结束时和 slice_it 一样关闭文件
+        :param stop: None 时到数据源结束
+        """
+        if self.index is None:
+            self.index = self._open_index(None)
+        self._write_slices(start, stop, checkpoint=False)
+
+    def _write_slices(self, n, stop=None, checkpoint=True):
+        if self.input_format == self.output_format == "csv" and self.processor is None and self.batch_processor is None:
+            return self._copy_csv_slices(n, stop, checkpoint)
+        if self.index is not None and not self.seek_slice(n):
+            self.close()
+            return
+
+        while stop is None or n < stop:
+            file_path = self.slice_path(n)
+            writer = self.make_writer(file_path)
             try:
-                self.pace_loopper(workbook)
+                self.pace_loopper(writer)
             except StopIteration:
-                workbook.save(file_path)
+                finished = True
+            else:
+                finished = False
+            writer.close()
+            print(f"saving {file_path}")
+            self._slice_done(n, checkpoint)
+            n += 1
+            if finished:
+                self.close()
+                return
+
+    def _slice_done(self, n, checkpoint=True):
+        """保存索引, checkpoint 时记录第n个切片已经完成"""
+        if self.index is not None:
+            if checkpoint:
+                self.index.completed = n + 1
+            self.index.save()
+
+    def slice_by(self, keys, pace=None, max_open=64) -> dict:
+        """
+        按照 keys 列的值把每一行写入对应的文件, 只读取一遍数据源, 不需要排序, xlsx 使用 write_only 的工作簿
+        文件名为 "会员信息创建<文件名>_<key>_<第几个文件>.<后缀>", 和 max_open 无关
+        :param keys: 列名或者列的下标, 可以是多个
+        :param pace: 每个文件最多的行数, 超过之后写入同一个key的下一个文件; None 时不限制
+        :param max_open: 最多同时打开的文件数, 超过之后关闭最久没有写入的文件; 这个key再次出现时 csv 追加到原来的文件,
+               其他格式的文件关闭之后不能追加, 之后的行先缓存在临时文件中, 结束时接在原来的文件后面重新生成
+        :return: {key: [文件路径, ..]}, 多个列时key为tuple
+        """
+        if max_open < 1:
+            raise ValueError("max_open 至少为1")
+        key_of = self._key_function(keys)
+        limit = float("inf") if pace is None else pace
+        writers = OrderedDict()  # key: SliceWriter 或者 _SpillWriter, 最近写入的在最后
+        files = OrderedDict()  # key: [文件路径, ..]
+        counts = dict()  # key: 当前文件的行数
+        names = dict()  # key: 文件名中的key
+        used_names = set()
+        spilled = dict()  # key: 缓存的临时文件, 文件没有写满就被关闭的key(csv以外的格式)
+        temp_dir = None
+        try:
+            for value in self.iter_values():
+                key = key_of(value)
+                writer = writers.get(key)
+                if writer is not None and key not in spilled and counts[key] >= limit:
+                    self._close_writer(writers.pop(key))
+                    writer = None
+                if writer is None:
+                    paths = files.setdefault(key, [])
+                    if key in spilled:
+                        writer = _SpillWriter(spilled[key])
+                    elif paths and counts[key] < limit:
+                        if self.output_format == "csv":
+                            writer = CsvSliceWriter(paths[-1], self.template_title, self.template_head,
+                                                    encoding=self.encoding, append=True)
+                        else:
+                            if temp_dir is None:
+                                temp_dir = tempfile.mkdtemp(prefix="slice_by_")
+                            spilled[key] = os.path.join(temp_dir, str(len(spilled)))
+                            writer = _SpillWriter(spilled[key])
+                    else:
+                        if key not in names:
+                            names[key] = _unique_name(_file_name(key), used_names)
+                        paths.append(self._group_path(names[key], len(paths)))
+                        counts[key] = 0
+                        writer = self._group_writer(paths[-1])
+                    writers[key] = writer
+                    if len(writers) > max_open:
+                        self._close_writer(writers.popitem(last=False)[1])
+                else:
+                    writers.move_to_end(key)
+                writer.append(value)
+                if key not in spilled:
+                    counts[key] += 1
+
+            while writers:
+                self._close_writer(writers.popitem(last=False)[1])
+            for key, spill_path in spilled.items():
+                self._append_spilled(files[key], names[key], spill_path, pace)
+        finally:
+            while writers:
+                self._close_writer(writers.popitem(last=False)[1])
+            if temp_dir is not None:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        self.close()
+        return files
+
+    def _group_writer(self, file_path):
+        """
+        :rtype SliceWriter
+        """
+        if self.output_format == "xlsx":
+            return XlsxSliceWriter(file_path, self.template_title, self.template_head, write_only=True)
+        return self.make_writer(file_path)
+
+    def _append_spilled(self, paths, name, spill_path, pace):
+        """把缓存的行接在最后一个文件已有的行后面, 重新生成这个文件, 超过 pace 时写入下一个文件"""
+        rows = chain(_iter_slice_rows(self.output_format, paths[-1]), _iter_spilled(spill_path))
+        path = paths[-1]
+        while True:
+            target = path + ".tmp" if path == paths[-1] and os.path.exists(path) else path
+            writer = self._group_writer(target)
+            for row in islice(rows, pace):
+                writer.append(row)
+            writer.close()
+            if target != path:
+                os.replace(target, path)
+            print(f"saving {path}")
+            row = next(rows, None)
+            if row is None:
+                return
+            rows = chain([row], rows)
+            path = self._group_path(name, len(paths))
+            paths.append(path)
+
+    def _key_function(self, keys):
+        if isinstance(keys, (str, int)):
+            keys = [keys]
+        indexes = []
+        for key in keys:
+            if isinstance(key, int):
+                indexes.append(key)
+            elif key in self.template_head:
+                indexes.append(self.template_head.index(key))
+            else:
+                raise ValueError(f"没有找到列: {key}")
+
+        def key_of(row):
+            values = tuple(row[i] if i < len(row) else None for i in indexes)
+            return values[0] if len(values) == 1 else values
+
+        return key_of
+
+    def _group_path(self, name, n) -> str:
+        extension = WRITERS[self.output_format].extension
+        return os.path.join(self.save_to, "会员信息创建" + self.template_name + f"_{name}_{n}.{extension}")
+
+    @staticmethod
+    def _close_writer(writer):
+        writer.close()
+        if isinstance(writer, SliceWriter):
+            print(f"saving {writer.path}")
+
+    def _copy_csv_slices(self, n=0, stop=None, checkpoint=True):
+        """csv切分为csv, 按照记录复制原始的字节, 每个文件都复制原始的表头"""
+        self.close()
+        if self.index is not None and not self._scan_to(n):
+            return
+        with open(self.path, "rb") as source:
+            head = next(_iter_csv_records(source), b"")
+            position = len(head) if self.index is None else self.index.positions[n]
+            source.seek(position)
+            records = _iter_csv_records(source)
+            self.cursor = n * self.pace
+            while stop is None or n < stop:
+                file_path = self.slice_path(n)
+                count = 0
+                with open(file_path, "wb") as target:
+                    target.write(head)
+                    for record in islice(records, self.pace):
+                        target.write(record)
+                        position += len(record)
+                        count += 1
+                self.cursor += count
                 print(f"saving {file_path}")
+                # 和 slice_it 一样, 最后一个文件可能只有表头
+                finished = count < self.pace
+                if self.index is not None:
+                    if finished:
+                        self.index.total = n + 1
+                    else:
+                        self.index.record(n + 1, position)
+                self._slice_done(n, checkpoint)
                 n += 1
+                if finished:
+                    return
+
+    def slice_it_parallel(self, workers=None, max_pending=None):
+        """
+        流水线并行切分: 一个线程读取数据并调用 processor / batch_processor, 每 pace 行交给写入进程生成并保存一个文件,
+        文件名和内容与 slice_it 一致, 使用 checkpoint 时从第一个没有完成的切片开始
+        :param workers: 写入进程数, 默认为cpu数
+        :param max_pending: 最多同时存在的切片数(等待写入和正在写入), 默认为 workers * 2, 内存占用和它成正比
+        """
+        workers = workers or os.cpu_count() or 1
+        max_pending = max_pending or workers * 2
+        n = 0
+        if self.index is not None:
+            n = self.index.completed
+            if not self.seek_slice(n):
+                self.close()
                 return
-            workbook.save(file_path)
-            print(f"saving {file_path}")
-            n += 1
+        slices = queue.Queue(max_pending)
+        stop = threading.Event()
+        reader = threading.Thread(target=self._read_slices, args=(slices, stop, n), daemon=True)
+
+        pending = deque()
+        with ProcessPoolExecutor(workers) as pool:
+            # 先让进程池启动写入进程(fork 时第一次提交就会启动全部进程)再启动读取线程,
+            # 避免 fork 时读取线程正持有锁, 子进程中的锁永远无法释放
+            pool.submit(os.getpid).result()
+            reader.start()
+            try:
+                while True:
+                    item = slices.get()
+                    if item is None:
+                        break
+                    if isinstance(item, BaseException):
+                        # 已经提交的切片仍然会写完, 先记录到断点再抛出
+                        while pending:
+                            self._wait_slice(*pending.popleft())
+                        raise item
+                    n, rows = item
+                    file_path = self.slice_path(n)
+                    future = pool.submit(_save_slice, self.output_format, file_path, self.template_title,
+                                         self.template_head, rows, self._writer_options())
+                    pending.append((n, file_path, future))
+                    # 按照顺序等待, 保证输出的顺序以及同时存在的切片数
+                    while pending and (len(pending) >= max_pending or pending[0][2].done()):
+                        self._wait_slice(*pending.popleft())
+                while pending:
+                    self._wait_slice(*pending.popleft())
+            finally:
+                stop.set()
+                reader.join()
+        self.close()
+
+    def _wait_slice(self, n, file_path, future):
+        future.result()
+        print(f"saving {file_path}")
+        self._slice_done(n)
+
+    def _read_slices(self, slices, stop, n=0):
+        """读取线程, 从第n个切片开始放入 (n, rows), 结束时放入None, 出错时放入异常"""
+        try:
+            values = self.iter_values()
+            while not stop.is_set():
+                rows = list(islice(values, self.pace))
+                self.cursor += len(rows)
+                if not self._put(slices, (n, rows), stop):
+                    return
+                n += 1
+                # 和 slice_it 一样, 最后一个文件可能只有表头
+                if len(rows) < self.pace:
+                    break
+            self._put(slices, None, stop)
+        except Exception as e:
+            self._put(slices, e, stop)
+
+    @staticmethod
+    def _put(slices, item, stop) -> bool:
+        while not stop.is_set():
+            try:
+                slices.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+def _column_keys(rows, head) -> list:
+    width = max(len(head), max(len(row) for row in rows))
+    return list(head) + list(range(len(head), width))
+
+
+def _rows_to_columns(rows, head) -> dict:
+    return dict(zip(_column_keys(rows, head), (list(column) for column in zip_longest(*rows))))
+
+
+def _columns_to_rows(columns, head) -> list:
+    values = [column.tolist() if hasattr(column, "tolist") else column for column in columns.values()]
+    return [list(row) for row in zip(*values)]
+
+
+def _rows_to_dataframe(rows, head):
+    df = pandas.DataFrame(rows)
+    df.columns = _column_keys(rows, head)[:len(df.columns)]
+    return df
+
+
+def _dataframe_to_rows(df, head) -> list:
+    df = df.astype(object)
+    return df.where(df.notna(), None).values.tolist()
+
+
+def _identity(rows, head):
+    return rows
+
+
+# batch_format: (行转换为数据块, 数据块转换为行)
+BATCH_FORMATS = {
+    "rows": (_identity, _identity),
+    "columns": (_rows_to_columns, _columns_to_rows),
+    "dataframe": (_rows_to_dataframe, _dataframe_to_rows),
+}
+
+
+_invalid_file_name_pattern = re.compile(r'[\\/:*?"<>|\s]')
+
+
+def _file_name(key) -> str:
+    """把key转换为文件名的一部分"""
+    values = key if isinstance(key, tuple) else (key,)
+    return "_".join(_invalid_file_name_pattern.sub("_", "" if v is None else str(v)) for v in values)
+
+
+def _unique_name(name, used) -> str:
+    """
+    不同的key转换之后可能相同(比如 "a/b" 和 "a_b", 或者不区分大小写的文件系统中的 "A" 和 "a"), 之后出现的加上序号
+    :param used: 已经使用的文件名(小写), 会加入返回的文件名
+    """
+    unique, i = name, 1
+    while unique.lower() in used:
+        unique, i = f"{name}~{i}", i + 1
+    used.add(unique.lower())
+    return unique
+
+
+def _save_slice(output_format, file_path, title, head, rows, options):
+    """写入进程, 保存一个切片"""
+    writer = WRITERS[output_format](file_path, title, head, **options)
+    for row in rows:
+        writer.append(row)
+    writer.close()
+    return file_path
+
+
+def _template_workbook(title, head, write_only) -> Workbook:
+    if write_only:
+        wb = Workbook(write_only=True)
+        sheet = wb.create_sheet(title)
+    else:
+        wb = Workbook()
+        sheet = wb.active
+        sheet.title = title
+    sheet.append(head)
+    return wb
+
+
+class SliceWriter(abc.ABC):
+    """一个切片文件, 创建时写入表头, append 写入每一行, close 保存; 子类需要实现 append 和 close"""
+    extension = ""
+
+    def __init__(self, path, title, head):
+        self.path = path
+
+    @abc.abstractmethod
+    def append(self, row):
+        """写入一行"""
+
+    @abc.abstractmethod
+    def close(self):
+        """保存并关闭文件"""
+
+
+class XlsxSliceWriter(SliceWriter):
+    extension = "xlsx"
+
+    def __init__(self, path, title=None, head=None, write_only=True, workbook=None):
+        """
+        :param workbook: 已经写入表头的工作簿, 不传则根据 title 和 head 创建
+        """
+        super().__init__(path, title, head)
+        self.workbook = workbook or _template_workbook(title, head, write_only)
+        self.sheet = self.workbook.worksheets[0]
+
+    def append(self, row):
+        self.sheet.append(row)
+
+    def close(self):
+        self.workbook.save(self.path)
+
+
+class CsvSliceWriter(SliceWriter):
+    extension = "csv"
+
+    def __init__(self, path, title, head, encoding="utf-8-sig", append=False):
+        """
+        :param append: 追加到已有的文件, 不再写入表头
+        """
+        super().__init__(path, title, head)
+        self.file = open(path, "a" if append else "w", newline="", encoding=encoding)
+        self.writer = csv.writer(self.file)
+        if not append:
+            self.writer.writerow(head)
+
+    def append(self, row):
+        self.writer.writerow(row)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetSliceWriter(SliceWriter):
+    """
+    每 batch_size 行写入一个row group, 列的类型由已经写入的数据推断:
+    之前全部为空的列出现值之后使用新的类型, 类型不一致的列(如 int 和 str 混合)转换为字符串, 已经写入的row group按照新的类型重写
+    """
+    extension = "parquet"
+
+    def __init__(self, path, title, head, batch_size=10000):
+        super().__init__(path, title, head)
+        _require_pyarrow()
+        self.head = [str(h) for h in head]
+        self.batch_size = batch_size
+        self.rows = []
+        self.writer = None
+
+    def append(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        columns = list(zip_longest(*self.rows)) if self.rows else [()] * len(self.head)
+        schema = None if self.writer is None else self.writer.schema
+        arrays = []
+        for i, column in enumerate(columns):
+            if schema is None:
+                arrays.append(_arrow_array(column))
+                continue
+            written = schema.field(i).type
+            try:
+                array = _arrow_array(column, written)
+            except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+                array = _arrow_array(column)
+            promoted = _promote_arrow_type(written, array.type)
+            arrays.append(array if array.type == promoted else _arrow_array(column, promoted))
+        table = pyarrow.Table.from_arrays(arrays, names=self.head)
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        elif not table.schema.equals(schema):
+            self._rewrite(table.schema)
+        self.writer.write_table(table)
+        self.rows = []
+
+    def _rewrite(self, schema):
+        """按照新的类型重写已经写入的row group"""
+        self.writer.close()
+        temp_path = self.path + ".tmp"
+        os.replace(self.path, temp_path)
+        try:
+            self.writer = pyarrow.parquet.ParquetWriter(self.path, schema)
+            with pyarrow.parquet.ParquetFile(temp_path) as written:
+                for i in range(written.num_row_groups):
+                    self.writer.write_table(written.read_row_group(i).cast(schema))
+        finally:
+            os.remove(temp_path)
+
+    def close(self):
+        if self.rows or self.writer is None:
+            self._flush()
+        self.writer.close()
+
+
+def _arrow_array(values, arrow_type=None):
+    """
+    :param arrow_type: None 时推断类型, 类型不一致时使用字符串
+    """
+    if arrow_type is not None and pyarrow.types.is_string(arrow_type):
+        return pyarrow.array([None if v is None else str(v) for v in values], pyarrow.string())
+    try:
+        return pyarrow.array(values, type=arrow_type)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+        if arrow_type is not None:
+            raise
+        return _arrow_array(values, pyarrow.string())
+
+
+def _promote_arrow_type(written, new):
+    """已经写入的类型和新数据的类型合并, null 使用另一个类型, 数字之间使用更宽的类型, 其他不一致时使用字符串"""
+    if written.equals(new) or pyarrow.types.is_null(new):
+        return written
+    if pyarrow.types.is_null(written):
+        return new
+    try:
+        merged = pyarrow.unify_schemas([pyarrow.schema([("c", written)]), pyarrow.schema([("c", new)])],
+                                       promote_options="permissive")
+        return merged.field(0).type
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, pyarrow.ArrowNotImplementedError):
+        return pyarrow.string()
+
+
+class _SpillWriter:
+    """slice_by 中缓存被关闭的key之后的行, 使用pickle追加, 保留值的类型"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "ab")
+
+    def append(self, row):
+        pickle.dump(row, self.file, pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        self.file.close()
+
+
+def _iter_spilled(path):
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def _iter_slice_rows(output_format, path):
+    """读取已经生成的切片, 不包括表头"""
+    if output_format == "parquet":
+        yield from islice(_iter_parquet_rows(path), 1, None)
+        return
+    workbook = load_workbook(path, read_only=True)
+    try:
+        for row in islice(workbook.worksheets[0].iter_rows(values_only=True), 1, None):
+            yield list(row)
+    finally:
+        workbook.close()
+
+
+WRITERS = {"xlsx": XlsxSliceWriter, "csv": CsvSliceWriter, "parquet": ParquetSliceWriter}
+
+if pyarrow is not None:  # 没有安装pyarrow时跳过
+    __test__ = {"ParquetSliceWriter": """
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "slice.parquet")
+    >>> writer = ParquetSliceWriter(path, "t", ["id", "code", "late"], batch_size=2)
+    >>> for row in [[1, 1, None], [2, "a", None], [3, 3, 1.5]]:
+    ...     writer.append(row)
+    >>> writer.close()
+    >>> table = pyarrow.parquet.read_table(path)
+    >>> [str(t) for t in table.schema.types], table.column("code").to_pylist(), table.column("late").to_pylist()
+    (['int64', 'string', 'double'], ['1', 'a', '3'], [None, None, 1.5])
+    """}
+
+
+class SliceIndex:
+    """
+    切片的断点以及每个切片在数据源中的位置, 保存为json
+    positions[n] 为第n个切片第一行的位置: csv为字节偏移, 其他格式为行号(表头为第0行)
+    """
+    version = 1
+
+    def __init__(self, path=None, source=None):
+        """
+        :param path: json文件的路径, None 时不保存
+        :param source: 数据源的标识, 和保存的不一致时索引失效
+        """
+        self.path = path
+        self.source = source
+        self.positions = []
+        self.completed = 0  # 已经完成的切片数
+        self.total = None  # 切片总数, 读取到数据源结束之后才知道
+
+    @classmethod
+    def load(cls, path, source):
+        """
+        读取断点文件, 不存在或者数据源已经变化时返回空的索引
+        :rtype SliceIndex
+        """
+        index = cls(path, source)
+        if path is None or not os.path.exists(path):
+            return index
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != cls.version or data.get("source") != source:
+            print(f"{path} 和数据源不一致, 重新切分")
+            return index
+        index.positions = data["positions"]
+        index.completed = data["completed"]
+        index.total = data["total"]
+        return index
+
+    def record(self, n, position):
+        if n == len(self.positions):
+            self.positions.append(position)
+
+    def save(self):
+        """先写入临时文件再替换, 中断时不会留下不完整的断点文件"""
+        if self.path is None:
+            return
+        data = {"version": self.version, "source": self.source, "completed": self.completed, "total": self.total,
+                "positions": list(self.positions)}
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(temp_path, self.path)
+
+
+def _iter_parquet_rows(path, batch_size=10000, start=0):
+    """
+    第一行是列名
+    :param start: 开始的行号(列名为第0行), 跳过之前的row group
+    """
+    parquet_file = _require_pyarrow().parquet.ParquetFile(path)
+    if start == 0:
+        yield list(parquet_file.schema_arrow.names)
+        start = 1
+    skip, row_groups = start - 1, []
+    metadata = parquet_file.metadata
+    for i in range(metadata.num_row_groups):
+        num_rows = metadata.row_group(i).num_rows
+        if not row_groups and skip >= num_rows:
+            skip -= num_rows
+            continue
+        row_groups.append(i)
+    if not row_groups:
+        return
+    for batch in parquet_file.iter_batches(batch_size, row_groups=row_groups):
+        if skip >= batch.num_rows:
+            skip -= batch.num_rows
+            continue
+        if skip:
+            batch, skip = batch.slice(skip), 0
+        for row in zip(*[column.to_pylist() for column in batch.columns]):
+            yield list(row)
+
+
+def _iter_sheet_rows(sheet, min_row, values_only):
+    """
+    从第 min_row 行开始读取只读工作表
+    iter_rows(min_row) 仍然会解析之前的每一行, 因此先在解压之后的xml中跳过之前的 <row>, 只把剩下的交给openpyxl;
+    跳过依赖只读工作表的内部实现(parent._archive, _worksheet_path, _get_source), 没有这些属性时直接使用 iter_rows(min_row)
+    """
+    if min_row > 2 and callable(getattr(sheet, "_get_source", None)):
+        try:
+            source = _open_sheet_from(sheet, min_row)
+        except (AttributeError, KeyError):
+            # openpyxl的内部实现变化, 或者不是只读模式打开的工作表
+            source = None
+        if source is not None:
+            sheet = copy.copy(sheet)
+            sheet._get_source = lambda: source
+    yield from sheet.iter_rows(min_row=min_row, values_only=values_only)
+
+
+_sheet_data_pattern = re.compile(rb"<(?:[\w.-]+:)?sheetData[\s>/]")
+_row_pattern = re.compile(rb"<(?:[\w.-]+:)?row[\s>/][^>]*>")
+_sheet_data_end_pattern = re.compile(rb"</(?:[\w.-]+:)?sheetData\s*>")
+_row_number_pattern = re.compile(rb"""\sr\s*=\s*["'](\d+)["']""")
+
+
+def _open_sheet_from(sheet, min_row, chunk_size=1 << 20):
+    """
+    :return: 删除了 min_row 之前的 <row> 的xml, 没有行号(r属性)等无法按照行号跳转时返回None
+    """
+    source = sheet.parent._archive.open(sheet._worksheet_path)
+    buffer, head = b"", None
+    while True:
+        chunk = source.read(chunk_size)
+        buffer += chunk
+        if head is None:
+            match = _sheet_data_pattern.search(buffer)
+            end = -1 if match is None else buffer.find(b">", match.end() - 1)
+            if end == -1:
+                if not chunk:
+                    break
+                continue
+            if buffer[end - 1:end] == b"/":  # 空的 <sheetData/>
+                break
+            head, buffer = buffer[:end + 1], buffer[end + 1:]
+        scanned = 0
+        for match in _row_pattern.finditer(buffer):
+            number = _row_number_pattern.search(match.group())
+            if number is None:
+                source.close()
+                return None
+            if int(number.group(1)) >= min_row:
+                return io.BufferedReader(_ChainedReader([head, buffer[match.start():]], source))
+            scanned = match.end()
+        end_tag = _sheet_data_end_pattern.search(buffer, scanned)
+        if end_tag is not None:  # 没有 min_row 之后的行
+            return io.BufferedReader(_ChainedReader([head, buffer[end_tag.start():]], source))
+        # 之前的行已经跳过, 保留可能不完整的最后一个标签
+        last_tag = buffer.rfind(b"<", scanned)
+        buffer = buffer[last_tag:] if last_tag != -1 else b""
+        if not chunk:
+            break
+    source.close()
+    return None
+
+
+class _ChainedReader(io.RawIOBase):
+    """先读取 parts, 再读取 source"""
+
+    def __init__(self, parts, source):
+        self.parts = deque(part for part in parts if part)
+        self.source = source
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.parts:
+            part = self.parts.popleft()
+            if len(part) > len(b):
+                self.parts.appendleft(part[len(b):])
+                part = part[:len(b)]
+            b[:len(part)] = part
+            return len(part)
+        data = self.source.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.source.close()
+        super().close()
+
+
+def _iter_csv_rows(path, encoding, position=0, parse=True):
+    """
+    从字节偏移 position 开始读取csv
+    :param parse: False 时只计算位置, 不解析记录
+    :return: generator (行, 下一行的字节偏移)
+    """
+    with open(path, "rb") as source:
+        source.seek(position)
+        ends = deque()
+
+        def records():
+            offset = position
+            for record in _iter_csv_records(source):
+                offset += len(record)
+                ends.append(offset)
+                yield record
+
+        if not parse:
+            for _ in records():
+                yield None, ends.popleft()
+            return
+        # 每条记录都是完整的一行, csv.reader 每次只读取一条
+        decoder = codecs.getincrementaldecoder(encoding)()
+        for row in csv.reader(decoder.decode(record) for record in records()):
+            yield row, ends.popleft()
+
+
+def _iter_csv_records(lines):
+    """
+    把csv的原始行合并为记录, 引号中可以有换行: 引号的数量为奇数时记录还没有结束
+    (转义的引号是成对的, 不影响奇偶; gbk等编码的多字节字符不包含引号的字节)
+    """
+    parts, quotes = [], 0
+    for line in lines:
+        quotes += line.count(b'"')
+        if quotes % 2:
+            parts.append(line)
+            continue
+        if parts:
+            parts.append(line)
+            line = b"".join(parts)
+            parts = []
+        quotes = 0
+        yield line
+    if parts:
+        yield b"".join(parts)
@@ -1,19 +1,40 @@
 # -*- coding: utf-8 -*-
+import ast
+import csv
+import heapq
 import json
-from collections import namedtuple, defaultdict
-from copy import deepcopy
-from itertools import groupby
+import keyword
+import marshal
+import multiprocessing
+import operator
+import os
+import platform
+import re
+import sys
+import tempfile
+import warnings
+import weakref
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, namedtuple, defaultdict
+from itertools import chain, groupby
 from logging import getLogger
-from operator import itemgetter
+from operator import attrgetter, itemgetter
+from timeit import default_timer
 
-from six import PY2, string_types
-from six.moves import filter, filterfalse
+from six import PY2, iteritems, string_types
+from six.moves import cPickle as pickle, filter, filterfalse
 from six.moves.reprlib import repr
 
 if PY2:
-    from collections import Iterable
+    from collections import Iterable, Mapping
 else:
-    from collections.abc import Iterable
+    from collections.abc import Iterable, Mapping
+
+try:
+    import numpy as np
+except ImportError:  # 列式数据的向量化计算需要numpy
+    np = None
 
 _logger = getLogger(__name__)
 
@@ -22,15 +43,151 @@ def is_non_string_iterable(obj):
     return isinstance(obj, Iterable) and (not isinstance(obj, string_types))
 
 
+def partition(key, data):
+    """
+    一次遍历将数据分为两部分, 列表中保存的是原数据的引用
+    :return: (满足key的列表, 不满足key的列表)
+    >>> partition(lambda x: x > 1, iter([1, 2, 3]))
+    ([2, 3], [1])
+    """
+    included, excluded = list(), list()
+    include, exclude = included.append, excluded.append
+    for x in data:
+        if key(x):
+            include(x)
+        else:
+            exclude(x)
+    return included, excluded
+
+
+class ColumnarData(object):
+    """
+    列式数据, 可以是 {field: numpy.ndarray} 或者 pandas.DataFrame,
+    OrderSplitter 对列式数据使用向量化计算, 拆分的结果是行号(numpy.ndarray), 可以用 column[index] 或者 df.iloc[index] 取出数据
+    """
+
+    def __init__(self, data):
+        if np is None:
+            raise ImportError(u"列式数据需要安装numpy")
+        self.data = data
+        self._columns = dict()
+
+    @classmethod
+    def is_columnar(cls, data):
+        if isinstance(data, cls):
+            return True
+        if np is None:
+            return False
+        if isinstance(data, dict):
+            return bool(data) and all(isinstance(v, np.ndarray) for v in data.values())
+        # pandas.DataFrame, 不需要引入pandas
+        return hasattr(data, "columns") and hasattr(data, "iloc")
+
+    @classmethod
+    def wrap(cls, data):
+        return data if isinstance(data, cls) else cls(data)
+
+    def __len__(self):
+        if isinstance(self.data, dict):
+            return len(next(iter(self.data.values())))
+        return len(self.data)
+
+    def has_column(self, field):
+        return field in self.data
+
+    def column(self, field):
+        """
+        :return: numpy.ndarray, 和 dict.get 一样, 没有这一列时返回全是None的列
+        """
+        column = self._columns.get(field)
+        if column is None:
+            if self.has_column(field):
+                column = np.asarray(self.data[field])
+            else:
+                column = np.full(len(self), None, dtype=object)
+            self._columns[field] = column
+        return column
+
+    def all_rows(self):
+        return np.arange(len(self))
+
+
+def _to_python(value):
+    """numpy的标量转换为python对象"""
+    return value.item() if np is not None and isinstance(value, np.generic) else value
+
+
+def _factorize(column, sort=True):
+    """
+    :return: (uniques, codes) codes是每一行在uniques中的下标, sort=False时uniques按照第一次出现的顺序
+    """
+    try:
+        if sort:
+            return np.unique(column, return_inverse=True)
+        uniques, first, codes = np.unique(column, return_index=True, return_inverse=True)
+    except TypeError:
+        if sort:
+            raise
+        # 混合类型(如None和int)无法排序, 使用字典分组
+        index = OrderedDict()
+        codes = np.fromiter((index.setdefault(v, len(index)) for v in column.tolist()), dtype=np.intp,
+                            count=len(column))
+        uniques = np.empty(len(index), dtype=object)
+        uniques[:] = list(index)
+        return uniques, codes
+    order = np.argsort(first, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return uniques[order], rank[codes.ravel()]
+
+
+def iter_json_lines(lines):
+    """
+    逐行读取JSON-lines, 可以配合 OrderSplitter.iter_split(memory_limit=) 使用
+    :param lines: 文件对象或者任意的字符串迭代器
+    """
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def iter_csv_rows(lines, **kwargs):
+    """
+    逐行读取CSV, 每一行为一个字典, 第一行作为表头
+    :param lines: 文件对象或者任意的字符串迭代器
+    :param kwargs: csv.DictReader 的参数
+    """
+    for row in csv.DictReader(lines, **kwargs):
+        yield row
+
+
+_dimension_types = dict()
+
+
+def _dimension_type(fields):
+    """相同字段的维度共用一个namedtuple类, 避免重复创建"""
+    fields = tuple(fields)
+    res = _dimension_types.get(fields)
+    if res is None:
+        res = _dimension_types[fields] = namedtuple("dimension", fields)
+    return res
+
+
 class DummyDimension(object):
     pass
 
 
 class Dimension(object):
 
+    group_modes = ("sorted", "hash")
+
     def __init__(self, *fields, **kwargs):
         """
         :param fields: list[str] 不同维度的group
+        :param group_mode: enum[sorted, hash] 分组方式, 默认sorted
+            - sorted 先按照维度排序再使用groupby分组, 分组按照维度的值从小到大返回
+            - hash 只遍历一次数据, 使用字典按照维度分桶, 分组按照维度第一次出现的顺序返回, 维度的值不需要可以比较大小
         >>> data = [{"name": 1, "type": 1}, {"name": 2, "type": 1}, {"name": 3, "type": 2}]
         >>> dim = Dimension("type")
         >>> g = dim.iter_group(data)
@@ -44,54 +201,329 @@ class Dimension(object):
         dimension(type=2)
         >>> list(g_value) == [{"name": 3, "type": 2}]
         True
+        >>> data = [{"name": 1, "type": 2}, {"name": 2, "type": None}, {"name": 3, "type": 2}]
+        >>> [(g_name.type, [x["name"] for x in g_value]) for g_name, g_value in Dimension("type", group_mode="hash").iter_group(data)]
+        [(2, [1, 3]), (None, [2])]
         """
         self.fields = list(fields)
-        self._key_value_obj = namedtuple("dimension", fields)
+        self._key_value_obj = _dimension_type(fields)
 
         if "getter" in kwargs:
             self.getter = kwargs["getter"]
         else:
             self.getter = itemgetter
+        self.group_mode = self._check_group_mode(kwargs.get("group_mode", "sorted"))
         object.__init__(self)
 
     def __getstate__(self):
-        return self.fields, self.getter
+        return self.fields, self.getter, self.group_mode
 
     def __setstate__(self, state):
-        fields, getter = state
+        fields, getter = state[:2]
         self.fields = fields
-        self._key_value_obj = namedtuple("dimension", fields)
+        self._key_value_obj = _dimension_type(fields)
         self.getter = getter
+        self.group_mode = state[2] if len(state) > 2 else "sorted"
+
+    @classmethod
+    def _check_group_mode(cls, group_mode):
+        if group_mode not in cls.group_modes:
+            raise ValueError(u"不支持的分组方式: {}".format(group_mode))
+        return group_mode
 
-    def group(self, data):
+    def group(self, data, group_mode=None):
         """
         根据不同维度分组
         :param data:
         :type data: list
+        :param group_mode: enum[sorted, hash] 不传则使用维度自身的分组方式
         :return: 根据fields分组的数据
         """
+        group_mode = self._check_group_mode(group_mode or self.group_mode)
         try:
+            if group_mode == "hash":
+                return self._hash_group(data)
             sorted_data = sorted(data, key=self.getter(*self.fields))
             grouped_data = groupby(sorted_data, self.getter(*self.fields))
             return grouped_data
-        except KeyError:
+        except (LookupError, AttributeError):
             raise KeyError(u"没有找到拆单维度条件")
 
-    def iter_group(self, data):
+    def _hash_group(self, data):
+        """只遍历一次数据, 按照维度的值分桶, 保持维度第一次出现的顺序"""
+        key = self.getter(*self.fields)
+        buckets = OrderedDict()
+        for row in data:
+            value = key(row)
+            bucket = buckets.get(value)
+            if bucket is None:
+                bucket = buckets[value] = []
+            bucket.append(row)
+        return iteritems(buckets)
+
+    def iter_group(self, data, group_mode=None):
         """
         更加友好地迭代group过的数据
         :param data:
-        :return: (namedtuple ,  <groupby-instance>)
+        :param group_mode: enum[sorted, hash] 不传则使用维度自身的分组方式
+        :return: (namedtuple ,  <groupby-instance>), hash分组时为 (namedtuple, list)
         """
-        _data = self.group(data)
+        _data = self.group(data, group_mode)
         for values, g in _data:
-            values = values if is_non_string_iterable(values) else (values,)
-            yield self._key_value_obj(*values), g
+            yield self.to_key_value(values), g
+
+    def to_key_value(self, values):
+        """将 getter 取出的值转化为 namedtuple"""
+        values = values if is_non_string_iterable(values) else (values,)
+        return self._key_value_obj(*values)
+
+    def iter_group_indices(self, columns, group_mode=None):
+        """
+        列式数据的向量化分组, 和 iter_group 的分组顺序一致
+        :type columns ColumnarData
+        :return: (namedtuple, 行号 numpy.ndarray)
+        """
+        sort = self._check_group_mode(group_mode or self.group_mode) == "sorted"
+        codes = np.zeros(len(columns), dtype=np.int64)
+        for field in self.fields:
+            if not columns.has_column(field):
+                raise KeyError(u"没有找到拆单维度条件")
+            uniques, field_codes = _factorize(columns.column(field), sort)
+            codes = codes * len(uniques) + field_codes
+        _, group_codes = _factorize(codes, sort)
+        order = np.argsort(group_codes, kind="stable")
+        bounds = np.cumsum(np.bincount(group_codes))[:-1]
+        for index in np.split(order, bounds):
+            if not len(index):
+                continue
+            values = (_to_python(columns.column(field)[index[0]]) for field in self.fields)
+            yield self._key_value_obj(*values), index
 
     def add_dimension(self, dim):
         """添加一个维度"""
         self.fields.extend(dim)
-        self._key_value_obj = namedtuple("dimension", self.fields)
+        self._key_value_obj = _dimension_type(self.fields)
+
+
+class RecordLayout(object):
+    """
+    记录的结构, 初始化时把字段名解析为取值的方式, Dimension / Condition 共用同一个layout
+        - mapping: dict, 条件使用 x.get('field'), 不存在的字段为None
+        - sequence: tuple / list / namedtuple, 字段名解析为下标 x[0], 比dict节省内存, 取值也更快
+        - attribute: 对象或者 __slots__ 对象, 使用 x.field
+    >>> layout = RecordLayout.sequence(["type", "age"])
+    >>> Condition("age", "< 12", layout=layout).is_apply((1, 11))
+    True
+    >>> [(g_name.type, list(g_value)) for g_name, g_value in Dimension("type", getter=layout.getter).iter_group([(2, 1), (1, 3)])]
+    [(1, [(1, 3)]), (2, [(2, 1)])]
+    """
+
+    kinds = ("mapping", "sequence", "attribute")
+
+    def __init__(self, kind="mapping", fields=None):
+        """
+        :param kind: enum[mapping, sequence, attribute]
+        :param fields: sequence 时每个下标对应的字段名
+        """
+        if kind not in self.kinds:
+            raise ValueError(u"不支持的记录结构: {}".format(kind))
+        if kind == "sequence" and fields is None:
+            raise ValueError(u"sequence 需要字段名")
+        self.kind = kind
+        self.fields = None if fields is None else tuple(fields)
+        self._positions = None if fields is None else dict((field, i) for i, field in enumerate(self.fields))
+
+    @classmethod
+    def mapping(cls):
+        return cls("mapping")
+
+    @classmethod
+    def sequence(cls, fields):
+        return cls("sequence", fields)
+
+    @classmethod
+    def attributes(cls):
+        return cls("attribute")
+
+    @classmethod
+    def of(cls, record_type):
+        """
+        根据记录的类型选择结构, namedtuple 使用下标, dict 使用get, 其他的类(包括 __slots__ )使用属性
+        :type record_type type
+        :rtype RecordLayout
+        """
+        if issubclass(record_type, tuple) and hasattr(record_type, "_fields"):
+            return cls.sequence(record_type._fields)
+        if issubclass(record_type, Mapping):
+            return cls.mapping()
+        return cls.attributes()
+
+    def position(self, field):
+        try:
+            return self._positions[field]
+        except KeyError:
+            raise KeyError(u"记录中没有字段: {}".format(field))
+
+    def getter(self, *fields):
+        """和 itemgetter 一样, 一个字段时返回值本身, 多个字段时返回tuple, 可以作为 Dimension 的 getter"""
+        if self.kind == "sequence":
+            return itemgetter(*[self.position(field) for field in fields])
+        if self.kind == "attribute":
+            return attrgetter(*fields)
+        return itemgetter(*fields)
+
+    def expression(self, field, param):
+        """条件中取字段值的python表达式"""
+        if self.kind == "sequence":
+            return "{0}[{1}]".format(param, self.position(field))
+        if self.kind == "attribute":
+            if _identifier_pattern.match(field) and not keyword.iskeyword(field):
+                return "{0}.{1}".format(param, field)
+            return "getattr({0}, {1!r})".format(param, field)
+        return "{0}.get({1!r})".format(param, field)
+
+    def __eq__(self, other):
+        return isinstance(other, RecordLayout) and (self.kind, self.fields) == (other.kind, other.fields)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.kind, self.fields))
+
+    def __repr__(self):
+        return "RecordLayout({0!r}, {1!r})".format(self.kind, self.fields)
+
+
+_identifier_pattern = re.compile(r"[A-Za-z_]\w*$")
+
+
+class ConditionNode(object):
+    """
+    条件字符串解析之后的语法树节点, 用于判断条件的类型(比如向量化计算), 计算仍然使用 python_expression
+    """
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self), repr(self)))
+
+    def __repr__(self):
+        return "{0}({1})".format(type(self).__name__, ", ".join(
+            "{0}={1!r}".format(k, v) for k, v in sorted(self.__dict__.items())))
+
+
+class Compare(ConditionNode):
+    """比较: < 12, == 'A', is None"""
+
+    operators = OrderedDict([
+        ("<", operator.lt),
+        ("<=", operator.le),
+        (">", operator.gt),
+        (">=", operator.ge),
+        ("==", operator.eq),
+        ("!=", operator.ne),
+        ("is", operator.is_),
+        ("is not", operator.is_not),
+    ])
+
+    def __init__(self, op, value):
+        self.op = op
+        self.value = value
+
+
+class Membership(ConditionNode):
+    """成员: in (1, 2), not in ('A', 'B')"""
+
+    def __init__(self, values, negated=False):
+        self.values = values
+        self.negated = negated
+
+
+class MethodCall(ConditionNode):
+    """方法调用: startswith('L')"""
+
+    def __init__(self, method, args=()):
+        self.method = method
+        self.args = tuple(args)
+
+
+class Not(ConditionNode):
+    """
+    条件前的 'not ', 和 python_expression 一致, not 作用于字段的值: (not x.get('field')) < 12
+    """
+
+    def __init__(self, operand):
+        self.operand = operand
+
+
+_ast_compare_ops = {
+    ast.Lt: "<",
+    ast.LtE: "<=",
+    ast.Gt: ">",
+    ast.GtE: ">=",
+    ast.Eq: "==",
+    ast.NotEq: "!=",
+    ast.Is: "is",
+    ast.IsNot: "is not",
+}
+
+
+def parse_condition(condition):
+    """
+    将条件字符串解析为语法树, 支持比较, 成员, 方法调用以及not, 其他的写法返回None(仍然可以通过python_expression计算)
+    >>> parse_condition("< 12")
+    Compare(op='<', value=12)
+    >>> parse_condition("not startswith('L')")
+    Not(operand=MethodCall(args=('L',), method='startswith'))
+    >>> parse_condition("in (1, 2)")
+    Membership(negated=False, values=(1, 2))
+    >>> parse_condition("+ 1 > 2") is None
+    True
+
+    :type condition str
+    :rtype ConditionNode
+    """
+    negated = condition.startswith("not ")
+    if negated:
+        condition = condition.replace("not ", "")
+    if _is_method_call(condition):
+        condition = "." + condition
+
+    try:
+        node = ast.parse(BaseCondition._formal_parameter_name + " " + condition, mode="eval").body
+        res = None
+        if isinstance(node, ast.Compare) and len(node.ops) == 1 and _is_formal_parameter(node.left):
+            op, value = type(node.ops[0]), ast.literal_eval(node.comparators[0])
+            if op in _ast_compare_ops:
+                res = Compare(_ast_compare_ops[op], value)
+            elif isinstance(value, (tuple, list, set, frozenset)):
+                res = Membership(value, op is ast.NotIn)
+        elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+              and _is_formal_parameter(node.func.value) and not node.keywords):
+            res = MethodCall(node.func.attr, (ast.literal_eval(a) for a in node.args))
+    except (SyntaxError, ValueError):
+        return None
+    if res is not None and negated:
+        res = Not(res)
+    return res
+
+
+def _is_method_call(condition):
+    """startswith('L') 是方法调用, in (1, 2) / < len('a') 则不是"""
+    match = _method_call_pattern.match(condition)
+    return match is not None and not keyword.iskeyword(match.group(1))
+
+
+_method_call_pattern = re.compile(r"\s*([A-Za-z_]\w*)\s*\(")
+
+
+def _is_formal_parameter(node):
+    return isinstance(node, ast.Name) and node.id == BaseCondition._formal_parameter_name
 
 
 class BaseCondition(object):
@@ -99,6 +531,31 @@ class BaseCondition(object):
 
     is_true_condition = False
 
+    _compiled = None  # {name: (编译时的状态, 编译结果)}
+
+    _state_fields = frozenset()  # 决定 _compile_state 的属性
+    _watchers = None  # weakref.WeakSet, 使用了这个条件的粒度索引
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in self._state_fields and self._watchers:
+            # 只有使用了这个条件的索引需要重建, 创建其他条件不影响已经建立的索引
+            for index in list(self._watchers):
+                index.stale = True
+
+    def _watch(self, index):
+        """条件的 _state_fields 被修改时把 index.stale 设为True"""
+        if self._watchers is None:
+            self._watchers = weakref.WeakSet()
+        self._watchers.add(index)
+
+    def __getstate__(self):
+        # 编译好的谓词函数无法被序列化, 反序列化后会重新编译; 索引会在反序列化时重新注册
+        state = self.__dict__.copy()
+        state.pop("_compiled", None)
+        state.pop("_watchers", None)
+        return state
+
     def __hash__(self):
         return hash(True)
 
@@ -119,6 +576,60 @@ class BaseCondition(object):
     def python_expression(self):
         return "True"
 
+    def _compile_state(self):
+        """决定python_expression的状态, 状态发生变化时谓词需要重新编译"""
+        return None
+
+    def _compile_code(self, expression=None):
+        """将python_expression编译为 lambda x: expression 的code对象, 语法错误时抛出SyntaxError"""
+        source = "lambda {param}: {expression}".format(param=self._formal_parameter_name,
+                                                       expression=expression or self.python_expression)
+        return compile(source, str(self), "eval")
+
+    def _compile(self, expression=None):
+        """将python_expression编译为 lambda x: expression"""
+        try:
+            code = self._compile_code(expression)
+        except SyntaxError as e:
+            _logger.exception(e)
+            return lambda x: False
+        return eval(code, globals())
+
+    @property
+    def predicate(self):
+        """
+        编译后的谓词函数, 只有在字段或者条件变化之后才会重新编译, 谓词本身不会捕获异常
+        :return: function(x) -> bool
+        """
+        return self._cached("predicate", self._compile)
+
+    def _cached(self, name, build):
+        """缓存编译结果, 只有在 _compile_state 变化之后才重新调用build"""
+        state = self._compile_state()
+        if self._compiled is None:
+            self._compiled = dict()
+        cached = self._compiled.get(name)
+        if cached is None or cached[0] != state:
+            cached = self._compiled[name] = (state, build())
+        return cached[1]
+
+    @property
+    def key_function(self):
+        """
+        和to_key一样, 但是只取一次编译后的谓词, 适合对大量数据使用
+        :return: function(x) -> bool
+        """
+        predicate = self.predicate
+
+        def key(x):
+            try:
+                return predicate(x)
+            except Exception as e:
+                _logger.exception(e)
+                return False
+
+        return key
+
     def to_key(self, x):
         """
         将condition对象转换为 类似于 filter(key=) 的函数
@@ -126,7 +637,7 @@ class BaseCondition(object):
         :return: bool
         """
         try:
-            return eval(self.python_expression)
+            return self.predicate(x)
         except Exception as e:
             _logger.exception(e)
             return False
@@ -134,24 +645,15 @@ class BaseCondition(object):
     def apply(self, data):
         """
         将condition应用于过滤对象
-        :param data: 需要过滤的数据, 这个数据不能是一个生成器, 否则可能造成问题过滤不出值的问题
-              原因, 两个返回值同时使用一个生成器, 如果迭代任意一个生成器直接造成生成器内容被消耗
+        :param data: 需要过滤的数据, 如果是一个迭代器(如生成器, groupby的分组), 只能被迭代一次,
+              此时会一次遍历直接分为两个列表, 两个返回值可以分别迭代, 不会复制数据本身
         :type data Iterable
         :return: Filter(condition), Filter(not condition)
         """
-        data1 = data
-        if PY2:
-            if iter(data) is data:
-                # 这种情况表示data只能被迭代一次, 会产生数据错误
-                data = tuple(data)
-                data1 = data
-                # _logger.warning(u"传入了一个迭代器, 转化为tuple")
-        else:
-            if iter(data) is data:
-                data1 = deepcopy(data)
-                # _logger.warning(u"传入了一个迭代器, 使用deepcopy处理")
-
-        return filter(self.to_key, data), filterfalse(self.to_key, data1)
+        key = self.key_function
+        if iter(data) is data:
+            return partition(key, data)
+        return filter(key, data), filterfalse(key, data)
 
     def is_apply(self, single):
         """判断一个单独的对象, 是否满足当前的粒度划分
@@ -160,6 +662,20 @@ class BaseCondition(object):
         """
         return self.to_key(single)
 
+    def bind_layout(self, layout):
+        """
+        使用指定的记录结构取字段的值, 参考 RecordLayout
+        :type layout RecordLayout
+        """
+
+    def mask(self, columns):
+        """
+        对列式数据进行向量化计算
+        :type columns ColumnarData
+        :return: numpy.ndarray[bool]
+        """
+        return np.ones(len(columns), dtype=bool)
+
 
 class TrueCondition(BaseCondition):
     """
@@ -169,8 +685,11 @@ class TrueCondition(BaseCondition):
 
 
 class Condition(BaseCondition):
+    layout = None
+
+    _state_fields = frozenset(("field", "condition", "_get_method", "layout"))
 
-    def __init__(self, field, condition, get_method=None, **extra):
+    def __init__(self, field, condition, get_method=None, layout=None, **extra):
         """
         >>> condition1 = Condition("name", "startswith('L')")
         >>> condition2 = Condition("age", "< 12")
@@ -178,6 +697,8 @@ class Condition(BaseCondition):
         ".startswith('L')"
         >>> condition2.real_condition
         '< 12'
+        >>> Condition("age", "in (11, 12)").real_condition
+        'in (11, 12)'
         >>> included, excluded = condition1.apply(data=[{"name": "L1"}, {"name": "Y1"}])
         >>> list(included)
         [{'name': 'L1'}]
@@ -187,11 +708,14 @@ class Condition(BaseCondition):
         :param field: 对应某个字段
         :param condition: 对某个字段的过滤条件
         :param get_method: 默认当做字典处理, 如果传入的是对象, 应该改为 "__getattr__"
+        :param layout: 记录的结构, 传入之后忽略get_method, 参考 RecordLayout
+        :type layout RecordLayout
         """
         self.field = field
         self.condition = condition
         self.extra = defaultdict(None, **extra)
         self._get_method = get_method or "get"
+        self.layout = layout
         self._not_token = False
         self._real_condition = None
 
@@ -204,22 +728,30 @@ class Condition(BaseCondition):
     def __str__(self):
         return "<Condition {0}:{1}>".format(self.field, self.condition)
 
+    def _compile_state(self):
+        return self.field, self.condition, self._get_method, self.layout
+
+    def bind_layout(self, layout):
+        self.layout = layout
+
     @property
     def real_condition(self):
-        if self._real_condition is not None:
-            return self._real_condition
+        # _real_condition: (原始condition, 处理后的condition), condition被修改后重新计算
+        if self._real_condition is not None and self._real_condition[0] == self.condition:
+            return self._real_condition[1]
 
         condition = self.condition
-        if condition.startswith("not "):
-            self._not_token = True
+        self._not_token = condition.startswith("not ")
+        if self._not_token:
             condition = condition.replace("not ", "")
-        if "(" in condition and not condition.startswith("."):
-            self._real_condition = ".{condition}".format(
+        if _is_method_call(condition):
+            real_condition = ".{condition}".format(
                 field=self.field, condition=condition)
         else:
-            self._real_condition = "{condition}".format(
+            real_condition = "{condition}".format(
                 field=self.field, condition=condition)
-        return self._real_condition
+        self._real_condition = (self.condition, real_condition)
+        return real_condition
 
     @property
     def python_expression(self):
@@ -227,14 +759,109 @@ class Condition(BaseCondition):
         返回可以被eval的字符串, 如 x.get("name").startswith("x"), 更加安全的做法应该是判断get出来的对象是否有该方法
         :return:
         """
+        real_condition = self.real_condition  # 先解析condition, 确定_not_token
+        if self.layout is not None:
+            return "({not_flag} {value})".format(not_flag="not" if self._not_token else "",
+                                                 value=self.layout.expression(self.field, self._formal_parameter_name)
+                                                 ) + real_condition
         return "({not_flag} {param}.{method}('{field}'))".format(not_flag="not" if self._not_token else "",
                                                                  param=self._formal_parameter_name,
                                                                  method=self._get_method,
-                                                                 field=self.field) + self.real_condition
+                                                                 field=self.field) + real_condition
+
+    def _compile_value_predicate(self):
+        """编译只针对字段值的谓词 lambda x: (not x).startswith('L')"""
+        source = "lambda {param}: ({not_flag} {param})".format(
+            not_flag="not" if self._not_token else "",
+            param=self._formal_parameter_name) + self.real_condition
+        try:
+            return eval(compile(source, str(self), "eval"), globals())
+        except SyntaxError as e:
+            _logger.exception(e)
+            return lambda x: False
+
+    @property
+    def node(self):
+        """
+        解析之后的条件, 参考 parse_condition
+        :rtype ConditionNode
+        """
+        return self._cached("node", lambda: parse_condition(self.condition))
+
+    def value_of(self, single):
+        """取出单条记录中该字段的值, 和 python_expression 的取值方式一致"""
+        if self.layout is not None:
+            return self._cached("value_getter", lambda: self.layout.getter(self.field))(single)
+        return getattr(single, self._get_method)(self.field)
+
+    def _compile_vectorized(self):
+        """
+        将常见的条件转换为numpy的向量化计算, 无法转换时返回None
+        支持: 比较(< 12, == 'a'), 成员(in (1, 2)), 字符串方法(startswith('L'))
+        """
+        node = self.node
+        if isinstance(node, Compare) and node.op in _vectorized_compare_ops:
+            compare, value = Compare.operators[node.op], node.value
+            return lambda column: compare(column, value)
+        if isinstance(node, Membership):
+            values, negated = list(node.values), node.negated
+            return lambda column: np.isin(column, values, invert=negated)
+        if isinstance(node, MethodCall) and node.method in _vectorized_str_methods:
+            method, args = getattr(np.char, node.method), node.args
+            # 只有numpy的字符串数组才能使用np.char, object数组逐个计算
+            return lambda column: method(column, *args) if column.dtype.kind in "US" else None
+        return None
+
+    def mask(self, columns):
+        column = columns.column(self.field)
+        vectorized = self._cached("vectorized", self._compile_vectorized)
+        if vectorized is not None:
+            try:
+                res = vectorized(column)
+                if res is not None:
+                    res = np.asarray(res, dtype=bool)
+                    if res.shape == column.shape:
+                        return res
+            except Exception:
+                pass
+
+        # 逐个计算, 和 to_key 一样, 出现异常时视为不满足
+        predicate = self._cached("value_predicate", self._compile_value_predicate)
+        errors = list()
+
+        def key(value):
+            try:
+                return bool(predicate(value))
+            except Exception as e:
+                errors.append(e)
+                return False
+
+        res = np.fromiter((key(v) for v in column.tolist()), dtype=bool, count=len(column))
+        if errors:
+            _logger.warning(u"%s: %d 行计算失败, 第一个错误: %r", self, len(errors), errors[0])
+        return res
+
+
+_vectorized_compare_ops = ("<", "<=", ">", ">=", "==", "!=")
+
+_vectorized_str_methods = ("startswith", "endswith", "isdigit", "isalpha", "isalnum", "isspace",
+                           "islower", "isupper", "istitle", "isnumeric", "isdecimal")
 
 
 class Granularity(BaseCondition):
-    """condition的集合, 形成粒度条件, 粒度的不同条件之间必须使用`并且(and)`的条件关联, 和Condition有一样的API"""
+    """condition的集合, 形成粒度条件, 粒度的不同条件之间必须使用`并且(and)`的条件关联, 和Condition有一样的API
+
+    计算时会先采样 reorder_sample_size 行, 统计每个条件的耗时和拒绝率, 然后把耗时短, 拒绝率高的条件放在前面,
+    and 的短路可以尽早跳过剩下的条件, 过滤结果不受影响;
+    抛出异常不算拒绝, 并且抛出异常的条件不会被移到拒绝了同一行的条件前面, 原来被短路的异常不会因为调整顺序而出现
+    """
+
+    # 采样的行数, 0 表示按照声明的顺序计算
+    reorder_sample_size = 1000
+
+    _order = None  # (条件的状态, 调整之后条件的下标)
+
+    _state_fields = frozenset(("conditions",))
 
     def __init__(self, *conditions, **extra):
         """
@@ -251,6 +878,7 @@ class Granularity(BaseCondition):
         """
         self.conditions = conditions
         self.extra = defaultdict(None, **extra)
+        self._order = None
         object.__init__(self)
 
     def __hash__(self):
@@ -266,26 +894,143 @@ class Granularity(BaseCondition):
         return "<Condition {}>".format(repr(self.conditions))
 
     @classmethod
-    def from_json(cls, json_data, **extra):
+    def from_json(cls, json_data, layout=None, **extra):
         """
         将Json转化为粒度
         :param json_data:{field1: condition1, field2: condition2, field2: condition3}
+        :param layout: 记录的结构, 参考 RecordLayout
         :return: Granularity
         """
         dict_data = json.loads(json_data)
-        return cls.from_dict(dict_data, **extra)
+        return cls.from_dict(dict_data, layout, **extra)
 
     @classmethod
-    def from_dict(cls, dict_data, **extra):
+    def from_dict(cls, dict_data, layout=None, **extra):
         """
         :param dict_data: {field1: condition1, field2: condition2, field2: condition3}
+        :param layout: 记录的结构, 参考 RecordLayout
         :return: Granularity
         """
         res = list()
         for field, str_condition in dict_data.items():
-            res.append(Condition(field=field, condition=str_condition))
+            res.append(Condition(field=field, condition=str_condition, layout=layout))
         return cls(*res, **extra)
 
+    def _watch(self, index):
+        super(Granularity, self)._watch(index)
+        for condition in self.conditions:
+            condition._watch(index)
+
+    def bind_layout(self, layout):
+        for condition in self.conditions:
+            condition.bind_layout(layout)
+
+    def _conditions_state(self):
+        return tuple(condition._compile_state() for condition in self.conditions)
+
+    def _compile_state(self):
+        return self._conditions_state(), self._order
+
+    @property
+    def ordered_conditions(self):
+        """实际计算时条件的顺序"""
+        if self._order is None or self._order[0] != self._conditions_state():
+            return self.conditions
+        return tuple(self.conditions[index] for index in self._order[1])
+
+    def fused_expression(self):
+        """按照实际计算的顺序 and 连接的表达式, 还需要采样调整顺序时返回None"""
+        ordered = self.ordered_conditions
+        if self.reorder_sample_size and len(self.conditions) > 1 and ordered is self.conditions:
+            return None
+        return " and ".join(condition.python_expression for condition in ordered)
+
+    def _compile(self, expression=None):
+        expression = self.fused_expression()
+        if expression is None:
+            return self._profiling_predicate()
+        return super(Granularity, self)._compile(expression)
+
+    def _profiling_predicate(self):
+        """
+        逐个计算所有的条件并统计耗时和拒绝率, 采样结束后调整条件的顺序, 之后直接使用重新编译的谓词
+        返回值以及异常和按照声明顺序 and 连接的结果一致
+        """
+        conditions_state = self._conditions_state()
+        predicates = [condition.predicate for condition in self.conditions]
+        costs = [0.0] * len(predicates)
+        rejected = [0] * len(predicates)
+        before = set()  # (拒绝的条件, 同一行抛出异常的条件)
+        samples = [0]
+        ordered = list()
+
+        def predicate(x):
+            if ordered:
+                return ordered[0](x)
+
+            results = list()
+            for index, condition_predicate in enumerate(predicates):
+                start = default_timer()
+                try:
+                    value, error = condition_predicate(x), None
+                except Exception as e:
+                    value, error = False, e
+                costs[index] += default_timer() - start
+                if error is None and not value:
+                    rejected[index] += 1
+                results.append((value, error))
+
+            failed = [index for index, (_, error) in enumerate(results) if error is not None]
+            if failed:
+                before.update((index, failed_index) for index, (value, error) in enumerate(results)
+                              if error is None and not value for failed_index in failed)
+
+            samples[0] += 1
+            if samples[0] >= self.reorder_sample_size:
+                self._order = (conditions_state, self._rank(costs, rejected, samples[0], before))
+                ordered.append(self.predicate)
+
+            for value, error in results:
+                if error is not None:
+                    raise error
+                if not value:
+                    return value
+            return value
+
+        return predicate
+
+    @staticmethod
+    def _rank(costs, rejected, samples, before=()):
+        """
+        按照 平均耗时 / 拒绝率 从小到大排序, 从不拒绝的条件放在最后
+        >>> Granularity._rank([1.0, 0.1, 0.5], [10, 10, 0], 10)
+        (1, 0, 2)
+        >>> Granularity._rank([1.0, 0.1, 0.5], [10, 10, 0], 10, before={(0, 1)})
+        (0, 1, 2)
+
+        :param before: {(i, j), ..} 条件i必须在条件j前面, 互相矛盾时保持声明的顺序
+        """
+        def rank(index):
+            rejection = float(rejected[index]) / samples
+            return costs[index] / rejection if rejection else float("inf"), costs[index], index
+
+        remaining = set(range(len(costs)))
+        order = list()
+        while remaining:
+            ready = [j for j in remaining if not any(i in remaining for i, k in before if k == j)]
+            if not ready:
+                return tuple(range(len(costs)))
+            chosen = min(ready, key=rank)
+            order.append(chosen)
+            remaining.remove(chosen)
+        return tuple(order)
+
+    def mask(self, columns):
+        res = np.ones(len(columns), dtype=bool)
+        for condition in self.conditions:
+            res &= condition.mask(columns)
+        return res
+
     @property
     def real_condition(self):
         """useless"""
@@ -301,6 +1046,789 @@ class Granularity(BaseCondition):
         return " and ".join(python_expression_list)
 
 
+class SplitCounter(object):
+    """单个粒度或者条件的统计"""
+
+    __slots__ = ("name", "tested", "matched", "errors", "seconds")
+
+    def __init__(self, name):
+        self.name = name
+        self.tested = 0
+        self.matched = 0
+        self.errors = 0
+        self.seconds = 0.0
+
+    def add(self, tested=0, matched=0, errors=0, seconds=0.0):
+        self.tested += tested
+        self.matched += matched
+        self.errors += errors
+        self.seconds += seconds
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __repr__(self):
+        return "<SplitCounter {name} tested={tested} matched={matched} errors={errors} seconds={seconds:.6f}>".format(
+            **self.to_dict())
+
+
+class SplitStats(object):
+    """
+    拆单的统计信息, 赋值给 OrderSplitter.stats 之后开始统计, 为None时不统计
+        - grouping_seconds / filtering_seconds: 维度分组和粒度过滤的耗时
+        - groups: {维度: [SplitCounter, ...]} 每个维度分组中每个粒度的 测试行数, 满足行数, 异常数, 耗时
+        - conditions: {条件: SplitCounter} full模式中多个粒度共用, 单独计算的条件的统计, 所有分组合并统计
+    统计和不统计时的计算方式相同(包括条件的融合与采样之后的顺序), 支持 split / iter_split (包括 memory_limit)
+    以及 IncrementalOrderSplitter.add_batch; workers 多进程拆分不支持统计, apply_to / full_apply_to 不会记录统计
+    >>> stats = SplitStats()
+    >>> splitter = OrderSplitter(Dimension("type"), [Condition("name", "startswith('L')")], stats=stats)
+    >>> _ = splitter.split([{"type": 1, "name": "L1"}, {"type": 1, "name": None}])
+    >>> [(c.tested, c.matched, c.errors) for c in stats.groups[(1,)]]
+    [(2, 1, 1), (1, 1, 0)]
+    """
+
+    def __init__(self):
+        self.grouping_seconds = 0.0
+        self.filtering_seconds = 0.0
+        self.groups = OrderedDict()
+        self.conditions = OrderedDict()
+
+    def reset(self):
+        self.__init__()
+
+    def group(self, dim_info, granularities):
+        """:return: 维度分组对应的粒度统计, 与粒度一一对应"""
+        key = tuple(dim_info) if isinstance(dim_info, tuple) else None
+        counters = self.groups.get(key)
+        if counters is None:
+            counters = self.groups[key] = [SplitCounter(str(gra)) for gra in granularities]
+        return counters
+
+    def condition(self, condition):
+        name = str(condition)
+        counter = self.conditions.get(name)
+        if counter is None:
+            counter = self.conditions[name] = SplitCounter(name)
+        return counter
+
+    def to_dict(self):
+        return {
+            "grouping_seconds": self.grouping_seconds,
+            "filtering_seconds": self.filtering_seconds,
+            "groups": [{"dimension": list(key) if key is not None else None,
+                        "granularities": [counter.to_dict() for counter in counters]}
+                       for key, counters in self.groups.items()],
+            "conditions": [counter.to_dict() for counter in self.conditions.values()],
+        }
+
+
+class GranularityRouter(object):
+    """
+    粒度的路由, 只遍历一次数据
+        - remains模式(route): 将每一行分配给第一个满足的粒度, 每个粒度的谓词对每一行最多执行一次
+        - full模式(route_all): 多个粒度共用的Condition每一行只计算一次, 其他粒度使用融合之后的谓词
+    >>> router = GranularityRouter([Condition("name", "startswith('L')"), Condition("age", "< 12"), TrueCondition()])
+    >>> router.route([{"name": "L1", "age": 1}, {"name": "Y1", "age": 1}, {"name": "Y2", "age": 13}])
+    [[{'name': 'L1', 'age': 1}], [{'name': 'Y1', 'age': 1}], [{'name': 'Y2', 'age': 13}]]
+    >>> router.route_all([{"name": "L1", "age": 1}, {"name": "Y2", "age": 13}])
+    [[{'name': 'L1', 'age': 1}], [{'name': 'L1', 'age': 1}], [{'name': 'L1', 'age': 1}, {'name': 'Y2', 'age': 13}]]
+    """
+
+    def __init__(self, granularities):
+        """
+        :param granularities: 已经排好序的粒度
+        :type granularities list[BaseCondition]
+        """
+        self.granularities = list(granularities)
+        # TrueCondition 不需要计算, 它之后的粒度在remains模式下不可能再分到数据
+        self._keys = [None if gra.is_true_condition else gra.key_function for gra in self.granularities]
+        # 统计时使用, 和 key_function 中的谓词一致
+        self._predicates = [None if gra.is_true_condition else gra.predicate for gra in self.granularities]
+        self._timed = None  # (SplitStats, 统计的 indexes_of)
+
+        # 列式数据: 去重之后的条件, 每个粒度对应条件的下标, None表示TrueCondition, 每个条件只对整列计算一次
+        self.shared_conditions = list()
+        slots = dict()
+        self._plans = list()
+        for gra in self.granularities:
+            if gra.is_true_condition:
+                self._plans.append(None)
+                continue
+            plan = list()
+            for condition in self._conditions_of(gra):
+                key = self._condition_key(condition)
+                if key not in slots:
+                    slots[key] = len(self.shared_conditions)
+                    self.shared_conditions.append(condition)
+                plan.append(slots[key])
+            self._plans.append(tuple(plan))
+        self._indexes_of = self._compile_indexes_of()
+
+    @staticmethod
+    def _conditions_of(gra):
+        """按照实际计算的顺序(采样调整之后的顺序)返回粒度的条件"""
+        conditions = gra.ordered_conditions if isinstance(gra, Granularity) else (gra,)
+        return [condition for condition in conditions if not condition.is_true_condition]
+
+    @staticmethod
+    def _condition_key(condition):
+        # 依赖Condition的 __hash__/__eq__ 去重, 同时要求编译的状态(取值方式等)一致
+        return condition, type(condition), condition._compile_state()
+
+    def _compile_indexes_of(self, stats=None):
+        """
+        full模式: 把所有粒度编译为一个逐行计算的函数, 条件按照采样调整之后的顺序内联,
+        多个粒度共用的条件的结果保存在局部变量中, 每一行只计算一次, 其他连续的条件融合为一个表达式;
+        还在采样的粒度以及无法内联的粒度调用建立路由时的谓词, 采样结束之后重新建立的路由使用调整之后的顺序
+        :param stats: 传入时在同样的计算中统计每个粒度以及共用条件的 测试行数, 满足行数, 异常数, 耗时
+        :type stats SplitStats
+        :return: function(x) -> list 所有满足的粒度的下标; 统计时为 function(x, 与粒度一一对应的SplitCounter) -> list
+        """
+        param = BaseCondition._formal_parameter_name
+        sampling = [isinstance(gra, Granularity) and gra.fused_expression() is None for gra in self.granularities]
+        counts = defaultdict(int)
+        for gra, is_sampling in zip(self.granularities, sampling):
+            if not gra.is_true_condition and not is_sampling:
+                for key in set(self._condition_key(condition) for condition in self._conditions_of(gra)):
+                    counts[key] += 1
+
+        timed = stats is not None
+        namespace = dict(globals())
+        namespace.update(_log=_logger.exception, _timer=default_timer)
+        slots = dict()
+        body = list()
+
+        def emit(indent, *lines):
+            body.extend(indent + line for line in lines if line)
+
+        def evaluate(indent, name, expression, counter=None):
+            """计算表达式, 异常时记录日志并且为False; counter 为共用条件的统计"""
+            emit(indent, "_st = _timer()" if counter else "",
+                 "try:", "    {0} = bool({1})".format(name, expression), "except Exception as e:", "    _log(e)",
+                 "    {0} = False".format(name), "    _c.errors += 1" if timed else "",
+                 "    {0}.errors += 1".format(counter) if counter else "",
+                 "{0}.add(tested=1, matched={1}, seconds=_timer() - _st)".format(counter, name) if counter else "")
+
+        for index, gra in enumerate(self.granularities):
+            if timed:
+                emit("    ", "_c = _counters[{0}]".format(index), "_c.tested += 1", "_t = _timer()")
+            matched_lines = ("res.append({0})".format(index), "_c.matched += 1" if timed else "")
+            steps = None
+            if not gra.is_true_condition:
+                steps = None if sampling[index] else self._inline_steps(gra, counts)
+            if gra.is_true_condition:
+                emit("    ", *matched_lines)
+            elif steps is None:
+                namespace["_pred{0}".format(index)] = self._predicates[index]
+                evaluate("    ", "matched", "_pred{0}({1})".format(index, param))
+                emit("    ", "if matched:")
+                emit("        ", *matched_lines)
+            else:
+                indent = "    "
+                for key, expression in steps:
+                    if key is None:
+                        evaluate(indent, "matched", expression)
+                        emit(indent, "if matched:")
+                    else:
+                        slot = slots.setdefault(key, len(slots))
+                        counter = None
+                        if timed:
+                            counter = "_sc{0}".format(slot)
+                            namespace[counter] = stats.condition(key[0])
+                        emit(indent, "if s{0} is None:".format(slot))
+                        evaluate(indent + "    ", "s{0}".format(slot), expression, counter)
+                        emit(indent, "if s{0}:".format(slot))
+                    indent += "    "
+                emit(indent, *matched_lines)
+            if timed:
+                emit("    ", "_c.seconds += _timer() - _t")
+
+        head = ["def indexes_of({0}{1}):".format(param, ", _counters" if timed else ""), "    res = []"]
+        if slots:
+            head.append("    " + " = ".join("s{0}".format(slot) for slot in range(len(slots))) + " = None")
+        exec(compile("\n".join(head + body + ["    return res"]), "<GranularityRouter>", "exec"), namespace)
+        return namespace["indexes_of"]
+
+    def _inline_steps(self, gra, counts):
+        """
+        :return: [(共用条件的key或None, 表达式), ..], 无法内联时返回None
+        """
+        steps, run = list(), list()
+        for condition in self._conditions_of(gra):
+            if not isinstance(condition, Condition):
+                return None
+            expression = condition.python_expression
+            try:
+                condition._compile_code(expression)
+            except SyntaxError:
+                return None
+            key = self._condition_key(condition)
+            if counts[key] > 1:
+                if run:
+                    steps.append((None, " and ".join(run)))
+                    run = list()
+                steps.append((key, "(" + expression + ")"))
+            else:
+                run.append("(" + expression + ")")
+        if run:
+            steps.append((None, " and ".join(run)))
+        return steps
+
+    def index_of(self, single):
+        """
+        :return: 第一个满足的粒度的下标, 没有满足的粒度返回None
+        """
+        for index, key in enumerate(self._keys):
+            if key is None or key(single):
+                return index
+        return None
+
+    def indexes_of(self, single):
+        """
+        full模式使用, 和其他粒度共用的条件只计算一次
+        :return: 所有满足的粒度的下标
+        """
+        return self._indexes_of(single)
+
+    def route_all(self, data):
+        """
+        full模式, 每一行可能属于多个粒度
+        :return: 与粒度一一对应的列表, list[list]
+        """
+        buckets = [list() for _ in self.granularities]
+        indexes_of = self._indexes_of
+        for row in data:
+            for index in indexes_of(row):
+                buckets[index].append(row)
+        return buckets
+
+    def index_of_with_stats(self, single, counters):
+        """
+        和 index_of 的计算完全一致, 同时统计每个粒度的 测试行数, 满足行数, 异常数, 耗时
+        :param counters: 与粒度一一对应的 SplitCounter
+        """
+        for index, predicate in enumerate(self._predicates):
+            counter = counters[index]
+            counter.tested += 1
+            if predicate is None:
+                counter.matched += 1
+                return index
+            start = default_timer()
+            try:
+                matched = predicate(single)
+            except Exception as e:
+                _logger.exception(e)
+                matched = False
+                counter.errors += 1
+            counter.seconds += default_timer() - start
+            if matched:
+                counter.matched += 1
+                return index
+        return None
+
+    def indexes_of_with_stats(self, single, counters, stats):
+        """
+        和 indexes_of 的计算完全一致(同样的内联和共用条件), 同时统计每个粒度以及共用条件
+        :param counters: 与粒度一一对应的 SplitCounter
+        :type stats SplitStats
+        """
+        if self._timed is None or self._timed[0] is not stats:
+            self._timed = (stats, self._compile_indexes_of(stats))
+        return self._timed[1](single, counters)
+
+    def route_with_stats(self, data, first_match, granularity_counters, stats):
+        """
+        和 route / route_all 的结果以及计算方式一致, 同时统计每个粒度的 测试行数, 满足行数, 异常数, 耗时,
+        full模式中共用的条件单独计算, 它们的统计保存在 stats.conditions 中
+        :param first_match: True为remains模式, False为full模式
+        :param granularity_counters: 与粒度一一对应的 SplitCounter
+        :type stats SplitStats
+        """
+        buckets = [list() for _ in self.granularities]
+        for row in data:
+            if first_match:
+                index = self.index_of_with_stats(row, granularity_counters)
+                if index is not None:
+                    buckets[index].append(row)
+            else:
+                for index in self.indexes_of_with_stats(row, granularity_counters, stats):
+                    buckets[index].append(row)
+        return buckets
+
+    def masks(self, columns):
+        """
+        列式数据, 每个共用的条件只对整列计算一次
+        :type columns ColumnarData
+        :return: 与粒度一一对应的 numpy.ndarray[bool]
+        """
+        shared = [None] * len(self.shared_conditions)
+        res = list()
+        for plan in self._plans:
+            mask = np.ones(len(columns), dtype=bool)
+            for slot in plan or ():
+                if shared[slot] is None:
+                    shared[slot] = self.shared_conditions[slot].mask(columns)
+                mask &= shared[slot]
+            res.append(mask)
+        return res
+
+    def route(self, data):
+        """
+        :return: 与粒度一一对应的列表, list[list]
+        """
+        buckets = [list() for _ in self.granularities]
+        routes = list(zip(self._keys, buckets))
+        for row in data:
+            for key, bucket in routes:
+                if key is None or key(row):
+                    bucket.append(row)
+                    break
+        return buckets
+
+
+class SpillFile(object):
+    """
+    溢出到磁盘的临时文件, 每次溢出把一个桶的行序列化为一块, 所有的桶共用一个文件
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._file = None
+
+    def write(self, rows):
+        """
+        :return: 这一块在文件中的位置
+        """
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(dir=self.directory)
+        self._file.seek(0, os.SEEK_END)
+        offset = self._file.tell()
+        pickle.dump(rows, self._file, pickle.HIGHEST_PROTOCOL)
+        return offset
+
+    def read(self, offset):
+        self._file.seek(offset)
+        return pickle.load(self._file)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class SpillBucket(object):
+    """一个 (维度, 粒度) 的桶, 内存中的行溢出后只保存在文件中的位置, 迭代时按块读回, 顺序不变"""
+
+    def __init__(self, spill_file):
+        self.spill_file = spill_file
+        self.rows = list()
+        self.offsets = list()
+
+    def __len__(self):
+        return len(self.rows) + sum(size for _, size in self.offsets)
+
+    def __bool__(self):
+        return bool(self.rows or self.offsets)
+
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        for offset, _ in self.offsets:
+            for row in self.spill_file.read(offset):
+                yield row
+        for row in self.rows:
+            yield row
+
+    def append(self, row):
+        self.rows.append(row)
+
+    def spill(self):
+        if self.rows:
+            self.offsets.append((self.spill_file.write(self.rows), len(self.rows)))
+            self.rows = list()
+
+
+class SpillPartitions(object):
+    """
+    外部哈希分组: 按照维度的值把 (维度的值, 粒度下标, 行) 哈希到固定数量的分区, 内存中最多缓存 memory_limit 条,
+    超出后追加到每个分区的临时文件中; 读回时每个分区单独分组, 行数超过 memory_limit 并且有多个维度值的分区会再次分区,
+    常驻内存只和 memory_limit 有关, 和维度值的数量以及数据量无关
+    """
+
+    # 再次分区的最大层数, 哈希冲突严重时不再继续分区
+    max_level = 8
+
+    def __init__(self, memory_limit, directory=None, count=16, level=0):
+        """
+        :param memory_limit: 内存中最多缓存的条数
+        :param directory: 临时文件目录, 默认使用系统的临时目录
+        :param count: 分区数
+        :param level: 分区的层数, 每一层使用哈希值的不同位
+        """
+        self.memory_limit = memory_limit
+        self.directory = directory
+        self.level = level
+        # 每一层使用哈希值的不同位, hash((level, key)) 在不同的层之间是相关的, 再次分区时无法分开
+        self._divisor = count ** level
+        self.buffered = 0
+        self.buffers = [list() for _ in range(count)]
+        self.files = [None] * count
+        self.sizes = [0] * count
+        self.firsts = [_missing] * count  # 分区中第一个维度的值
+        self.mixed = [False] * count  # 分区中是否有多个维度的值
+
+    def add(self, key, index, row):
+        part = hash(key) // self._divisor % len(self.buffers)
+        self.buffers[part].append((key, index, row))
+        self.sizes[part] += 1
+        if not self.mixed[part]:
+            if self.firsts[part] is _missing:
+                self.firsts[part] = key
+            elif self.firsts[part] != key:
+                self.mixed[part] = True
+        self.buffered += 1
+        if self.buffered >= self.memory_limit:
+            self.spill()
+
+    def spill(self):
+        for part, buffer in enumerate(self.buffers):
+            if buffer:
+                if self.files[part] is None:
+                    self.files[part] = tempfile.TemporaryFile(dir=self.directory)
+                pickle.dump(buffer, self.files[part], pickle.HIGHEST_PROTOCOL)
+                self.buffers[part] = list()
+        self.buffered = 0
+
+    def _chunks(self, part):
+        """按照写入的顺序读回一个分区, 读完之后关闭临时文件"""
+        source = self.files[part]
+        if source is not None:
+            source.seek(0)
+            while True:
+                try:
+                    chunk = pickle.load(source)
+                except EOFError:
+                    break
+                yield chunk
+            source.close()
+            self.files[part] = None
+        buffer, self.buffers[part] = self.buffers[part], list()
+        yield buffer
+
+    def _iter_partitions(self):
+        """
+        :return: generator 每个分区的数据块的迭代器
+        """
+        for part in range(len(self.buffers)):
+            if not self.sizes[part]:
+                continue
+            if self.sizes[part] > self.memory_limit and self.mixed[part] and self.level < self.max_level:
+                child = SpillPartitions(self.memory_limit, self.directory, len(self.buffers), self.level + 1)
+                for chunk in self._chunks(part):
+                    for entry in chunk:
+                        child.add(*entry)
+                for chunks in child._iter_partitions():
+                    yield chunks
+            else:
+                yield self._chunks(part)
+
+    def iter_groups(self, size, sort=False):
+        """
+        读回所有的分区并按照维度的值分组, 每个分组的行先保存在内存中, 超过 memory_limit 后溢出到临时文件
+        :param size: 粒度的数量
+        :param sort: 按照维度的值排序, 否则为分区的顺序, 同一个分区中为第一次出现的顺序
+        :return: generator (维度的值, [每个粒度的行]), 没有行的粒度为空列表
+        """
+        spill_file = SpillFile(self.directory)
+        runs = list()  # sort 时每个分区排好序的 (维度的值, 每个桶在 spill_file 中的位置), 保存在 run_file 中
+        run_file = tempfile.TemporaryFile(dir=self.directory) if sort else None
+        for chunks in self._iter_partitions():
+            groups = OrderedDict()
+            buffered = 0
+            for chunk in chunks:
+                for key, index, row in chunk:
+                    buckets = groups.get(key)
+                    if buckets is None:
+                        buckets = groups[key] = [None] * size
+                    if index is None:
+                        continue
+                    if buckets[index] is None:
+                        buckets[index] = SpillBucket(spill_file)
+                    buckets[index].append(row)
+                    buffered += 1
+                    if buffered >= self.memory_limit:
+                        for group_buckets in groups.values():
+                            for bucket in group_buckets:
+                                if bucket is not None:
+                                    bucket.spill()
+                        buffered = 0
+            if not sort:
+                while groups:
+                    key, buckets = groups.popitem(last=False)
+                    yield key, [list() if bucket is None else bucket for bucket in buckets]
+                continue
+            run_file.seek(0, os.SEEK_END)
+            start = run_file.tell()
+            for key in sorted(groups):
+                offsets = list()
+                for bucket in groups.pop(key):
+                    if bucket is not None:
+                        bucket.spill()
+                    offsets.append(None if bucket is None else bucket.offsets)
+                pickle.dump((key, offsets), run_file, pickle.HIGHEST_PROTOCOL)
+            runs.append(_iter_run(run_file, start, run_file.tell()))
+        # 每个分区的维度值互不相同, 合并时不会比较到桶的位置
+        for key, offsets in heapq.merge(*runs):
+            buckets = list()
+            for bucket_offsets in offsets:
+                if bucket_offsets is None:
+                    buckets.append(list())
+                    continue
+                bucket = SpillBucket(spill_file)
+                bucket.offsets = bucket_offsets
+                buckets.append(bucket)
+            yield key, buckets
+        if run_file is not None:
+            run_file.close()
+
+
+def _iter_run(run_file, start, end):
+    """依次读出 run_file 中 [start, end) 之间的记录, 多个读取可以交替进行"""
+    while start < end:
+        run_file.seek(start)
+        record = pickle.load(run_file)
+        start = run_file.tell()
+        yield record
+
+
+class GranularityIndex(object):
+    """
+    单条记录的粒度索引, 查找的代价与可能匹配的粒度数量有关, 而不是粒度的总数
+    每个粒度选择一个可以索引的条件:
+        - == / in: 按照字段的值建立哈希索引
+        - startswith: 前缀树
+        - < <= > >=: 排好序的阈值, 二分查找
+    无法索引的粒度每次都是候选, 所有的候选最后都会使用完整的粒度条件校验, 所以结果和逐个判断完全一致;
+    前 scan_size 个粒度不建立索引, 直接逐个判断, 大部分记录在前几个粒度就能匹配时不需要查找索引
+    >>> index = GranularityIndex([Condition("type", "== 1"), Condition("name", "startswith('L')"),
+    ...                           Condition("age", "< 12")], scan_size=0)
+    >>> list(index.iter_apply_to({"type": 2, "name": "L1", "age": 11}))
+    [<Condition name:startswith('L')>, <Condition age:< 12>]
+    """
+
+    _anchor_priority = {"eq": 0, "prefix": 1, "range": 2}
+
+    # 直接逐个判断的粒度数量, 查找一次索引的代价大约是判断几个粒度
+    scan_size = 4
+
+    def __init__(self, granularities, scan_size=None):
+        """
+        :param granularities: 按照顺序查找的粒度
+        :type granularities list[BaseCondition]
+        :param scan_size: 不传则使用类属性 scan_size
+        """
+        self.granularities = list(granularities)
+        if scan_size is not None:
+            self.scan_size = scan_size
+        self._scanned = self.granularities[:self.scan_size]
+        self.stale = False  # 粒度的条件被修改之后为True, 需要重新建立
+        for gra in self.granularities:
+            gra._watch(self)
+        self._fields = dict()  # (字段, 取值方式): 取值的Condition
+        self._eq = dict()  # 字段: {值: [粒度下标]}, 不使用lambda, 缓存了索引的拆单助手也可以被序列化
+        self._prefix = defaultdict(dict)  # 字段: 前缀树, 节点的 None 保存粒度下标
+        self._range = defaultdict(list)  # (字段, 运算符): [(阈值, 粒度下标)]
+        self._always = list()  # 无法索引的粒度
+        self._sources = OrderedDict()  # (索引类型, 字段): 这个索引中最小的粒度下标
+
+        for position, gra in enumerate(self.granularities):
+            if position < self.scan_size:
+                continue
+            anchor = self._choose_anchor(gra)
+            if anchor is None:
+                self._always.append(position)
+                self._sources.setdefault(("always", None), position)
+            else:
+                self._add(position, *anchor)
+        # 每个 (字段, 运算符) 保存 [(阈值的排名, 粒度下标)], 按照粒度下标排序, 查找时按照排名过滤
+        self._range_thresholds = dict()
+        for key, entries in list(self._range.items()):
+            entries.sort(key=itemgetter(0))
+            self._range_thresholds[key] = [threshold for threshold, _ in entries]
+            self._range[key] = sorted(((rank, position) for rank, (_, position) in enumerate(entries)),
+                                      key=itemgetter(1))
+        self._source_list = list(self._sources.items())
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for gra in self.granularities:
+            gra._watch(self)
+
+    def _choose_anchor(self, gra):
+        if gra.is_true_condition:
+            return None
+        conditions = gra.conditions if isinstance(gra, Granularity) else (gra,)
+        anchors = list()
+        for condition in conditions:
+            if not isinstance(condition, Condition):
+                continue
+            entry = self._index_entry(condition)
+            if entry is not None:
+                anchors.append(entry)
+        if not anchors:
+            return None
+        return min(anchors, key=lambda anchor: self._anchor_priority[anchor[1]])
+
+    @staticmethod
+    def _index_entry(condition):
+        """:return: (condition, 索引类型, 索引的参数) 或者 None"""
+        node = condition.node
+        try:
+            if isinstance(node, Compare) and node.op == "==":
+                hash(node.value)
+                return condition, "eq", (node.value,)
+            if isinstance(node, Membership) and not node.negated:
+                for value in node.values:
+                    hash(value)
+                return condition, "eq", tuple(node.values)
+        except TypeError:
+            return None
+        if isinstance(node, Compare) and node.op in _range_ops and isinstance(node.value, (int, float)) \
+                and not isinstance(node.value, bool):
+            return condition, "range", (node.op, node.value)
+        if isinstance(node, MethodCall) and node.method == "startswith" and len(node.args) == 1:
+            prefixes = node.args[0] if isinstance(node.args[0], tuple) else (node.args[0],)
+            if prefixes and all(isinstance(p, string_types) for p in prefixes):
+                return condition, "prefix", prefixes
+        return None
+
+    def _add(self, position, condition, kind, args):
+        field = (condition.field, condition._get_method, condition.layout)
+        self._fields.setdefault(field, condition)
+        self._sources.setdefault((kind, field if kind != "range" else (field, args[0])), position)
+        if kind == "eq":
+            for value in set(args):
+                self._eq.setdefault(field, defaultdict(list))[value].append(position)
+        elif kind == "prefix":
+            for prefix in set(args):
+                node = self._prefix[field]
+                for char in prefix:
+                    node = node.setdefault(char, dict())
+                node.setdefault(None, list()).append(position)
+        else:
+            op, threshold = args
+            self._range[(field, op)].append((threshold, position))
+
+    def candidates(self, single):
+        """
+        :return: 前 scan_size 个粒度之后可能匹配的粒度下标的迭代器, 按照粒度的顺序;
+            各个索引按照其中最小的粒度下标依次合并, 只有迭代到这个下标时才会查找, 提前结束迭代时后面的索引都不会被查找
+        """
+        values = dict()  # 字段的值, 查找时才取值
+        heap = list()  # [(粒度下标, 索引的序号, 剩下的粒度下标)]
+        sources = enumerate(self._source_list)
+        n, (source, first) = next(sources, (None, (None, None)))
+        while True:
+            while source is not None and (not heap or first <= heap[0][0]):
+                positions = iter(self._lookup(source, single, values))
+                for position in positions:
+                    heapq.heappush(heap, (position, n, positions))
+                    break
+                n, (source, first) = next(sources, (None, (None, None)))
+            if not heap:
+                return
+            _, n_positions, positions = heap[0]
+            yield heap[0][0]
+            for position in positions:
+                heapq.heapreplace(heap, (position, n_positions, positions))
+                break
+            else:
+                heapq.heappop(heap)
+
+    def _lookup(self, source, single, values):
+        """:return: 一个索引中可能匹配的粒度下标, 按照粒度的顺序"""
+        kind, key = source
+        if kind == "always":
+            return self._always
+        field = key[0] if kind == "range" else key
+        if field not in values:
+            try:
+                values[field] = self._fields[field].value_of(single)
+            except Exception:
+                # 取值失败, 这个字段上的条件都不可能满足
+                values[field] = _missing
+        value = values[field]
+        if value is _missing:
+            return ()
+        if kind == "eq":
+            try:
+                return self._eq[field].get(value, ())
+            except TypeError:
+                return ()
+        if kind == "prefix":
+            if not isinstance(value, string_types):
+                return ()
+            node = self._prefix[field]
+            found = [node[None]] if None in node else list()
+            for char in value:
+                node = node.get(char)
+                if node is None:
+                    break
+                if None in node:
+                    found.append(node[None])
+            return found[0] if len(found) == 1 else sorted(set(chain.from_iterable(found)))
+        op = key[1]
+        entries, thresholds = self._range[key], self._range_thresholds[key]
+        try:
+            if op in ("<", "<="):
+                # value < threshold, 排名在 [start, len) 之间
+                low, high = (bisect_right if op == "<" else bisect_left)(thresholds, value), len(entries)
+            else:
+                # value > threshold, 排名在 [0, end) 之间
+                low, high = 0, (bisect_left if op == ">" else bisect_right)(thresholds, value)
+        except TypeError:
+            # 无法比较大小, 交给完整的条件判断
+            low, high = 0, len(entries)
+        return _ranked_positions(entries, low, high)
+
+    def iter_apply_to(self, single):
+        """按照粒度的顺序返回单条记录匹配的所有粒度"""
+        for gra in self._scanned:
+            if gra.is_apply(single):
+                yield gra
+        for position in self.candidates(single):
+            gra = self.granularities[position]
+            if gra.is_apply(single):
+                yield gra
+
+    def apply_to(self, single):
+        """:return: 单条记录匹配的第一个粒度, 没有匹配时返回None"""
+        for gra in self._scanned:
+            if gra.is_apply(single):
+                return gra
+        for position in self.candidates(single):
+            gra = self.granularities[position]
+            if gra.is_apply(single):
+                return gra
+        return None
+
+
+_range_ops = ("<", "<=", ">", ">=")
+
+
+def _ranked_positions(entries, low, high):
+    """按照粒度下标的顺序返回排名在 [low, high) 之间的粒度下标"""
+    if low == 0 and high == len(entries):
+        for _, position in entries:
+            yield position
+        return
+    for rank, position in entries:
+        if low <= rank < high:
+            yield position
+
+_missing = object()
+
+
 class OrderSplitter(object):
     """
     # 拆单助手, 让拆单更加方便!
@@ -315,7 +1843,8 @@ class OrderSplitter(object):
 
     """
 
-    def __init__(self, dimension=None, granularities=None, split_mode="remains"):
+    def __init__(self, dimension=None, granularities=None, split_mode="remains", group_mode=None, stats=None,
+                 layout=None):
         """
         :param dimension Dimension
         :param granularities [Granularity, ..], 也可以只传一个颗粒度
@@ -341,6 +1870,9 @@ class OrderSplitter(object):
                |                          yield  age < 12                     |                                       |  second filter
                |                                                       |                    yield x                   |  ohter filter
                |                                               full                                                   |  last time
+        :param group_mode enum[sorted, hash] 维度的分组方式, 不传则使用Dimension自身的分组方式, 参考 Dimension
+        :param stats SplitStats 统计split/iter_split每个维度分组中每个粒度和条件的耗时, 不传则不统计, 参考 SplitStats
+        :param layout RecordLayout 记录的结构, 传入之后维度和所有的条件都使用它取值, 参考 RecordLayout
         :type split_mode str
         :type dimension Dimension
         :type granularities list[BaseCondition] or BaseCondition
@@ -356,60 +1888,303 @@ class OrderSplitter(object):
             granularities.append(TrueCondition())
         self.granularity = granularities
         self.split_mode = split_mode
+        self.group_mode = group_mode
+        self.stats = stats
+        self._index = None
+        self.layout = None
+        if layout is not None:
+            self.bind_layout(layout)
+
+    def bind_layout(self, layout):
+        """
+        维度和所有的粒度使用指定的记录结构取值, 之后添加的维度和粒度也会使用
+        :type layout RecordLayout
+        """
+        self.layout = layout
+        self._index = None
+        if self.dimensions is not None:
+            self.dimensions.getter = layout.getter
+        for gra in self.granularity or ():
+            gra.bind_layout(layout)
+
+    def _apply_granularity(self, data, router=None):
+        router = router or self.make_router()
+        if self.split_mode == "remains":
+            buckets = router.route(data)
+        else:
+            buckets = router.route_all(data)
+        for filtered, gra in zip(buckets, router.granularities):
+            yield filtered, gra
 
-    def _apply_granularity(self, data):
-        unfiltered = data
-        for gra in self.granularity:
-            if self.split_mode == "remains":
-                filtered, unfiltered = gra.apply(unfiltered)
-                yield filtered, gra
-            else:
-                filtered, unfiltered = gra.apply(data)
-                yield filtered, gra
+    def make_router(self):
+        """拆分使用的路由, 参考 GranularityRouter
+        :rtype GranularityRouter
+        """
+        return GranularityRouter(self.granularity)
 
     def apply_dimensions(self, data):
         """
         :return: generator (namedtuple ,  <groupby-instance>)
         """
         if self.dimensions is None:
-            return DummyDimension(), data
-        return self.dimensions.iter_group(data)
+            return iter([(DummyDimension(), data)])
+        return self.dimensions.iter_group(data, self.group_mode)
 
-    def apply_granularity(self, data):
+    def apply_granularity(self, data, router=None):
         """
         这个函数需要特别说明, 对属于应用 粒度条件
         由于粒度条件可能是一个列表, 因此我们从粒度最大(condition最多)的开始应用, 随后递减应用, 知道所有的data都已经应用完毕,
+        只会遍历一次数据, 参考 GranularityRouter
         :param data:
+        :param router: 多次调用时可以传入同一个 make_router() 的结果, 避免重复构建
         :return: generator
         """
         if self.granularity is None:
             return data
 
-        return self._apply_granularity(data)
+        return self._apply_granularity(data, router)
+
+    def _make_split_router(self):
+        if self.granularity is None:
+            return None
+        return self.make_router()
+
+    def _iter_split_columnar(self, data):
+        """
+        列式数据的向量化拆分, 每个粒度只对整列计算一次, 分组后通过行号取出结果
+        :return: generator ( dimensions_info, Granularity, 行号 numpy.ndarray )
+        """
+        columns = ColumnarData.wrap(data)
+        if self.dimensions is None:
+            groups = iter([(DummyDimension(), columns.all_rows())])
+        else:
+            groups = self.dimensions.iter_group_indices(columns, self.group_mode)
+
+        if self.granularity is None:
+            for dim_info, index in groups:
+                yield dim_info, None, index
+            return
 
-    def split(self, data):
+        stats = self.stats
+        start = default_timer()
+        masks = self.make_router().masks(columns)
+        if stats is not None:
+            stats.filtering_seconds += default_timer() - start
+            groups = self._timed_groups(groups, stats)
+        for dim_info, index in groups:
+            counters = None if stats is None else stats.group(dim_info, self.granularity)
+            remaining = index
+            for position, (mask, gra) in enumerate(zip(masks, self.granularity)):
+                tested = remaining if self.split_mode == "remains" else index
+                selected = tested[mask[tested]]
+                if self.split_mode == "remains":
+                    remaining = remaining[~mask[remaining]]
+                if counters is not None:
+                    counters[position].add(tested=len(tested), matched=len(selected))
+                yield dim_info, gra, selected
+
+    @staticmethod
+    def _timed_groups(groups, stats):
+        """统计维度分组的耗时, 分组中的数据也在这里取出"""
+        while True:
+            start = default_timer()
+            try:
+                dim_info, grouped_data = next(groups)
+            except StopIteration:
+                stats.grouping_seconds += default_timer() - start
+                return
+            if iter(grouped_data) is grouped_data:
+                grouped_data = list(grouped_data)
+            stats.grouping_seconds += default_timer() - start
+            yield dim_info, grouped_data
+
+    def _iter_split_with_stats(self, data):
+        stats = self.stats
+        router = self.make_router()
+        first_match = self.split_mode == "remains"
+        for dim_info, grouped_data in self._timed_groups(self.apply_dimensions(data), stats):
+            if not grouped_data:
+                continue
+            start = default_timer()
+            buckets = router.route_with_stats(grouped_data, first_match, stats.group(dim_info, router.granularities),
+                                              stats)
+            stats.filtering_seconds += default_timer() - start
+            for filtered, gra in zip(buckets, router.granularities):
+                yield dim_info, gra, filtered
+
+    def split(self, data, workers=None):
         """
         先应用维度, 再应用粒度对data进行分组
+        :param data: 行数据, 或者列式数据(参考 ColumnarData), 列式数据返回的是每一组的行号
+        :param workers: 使用多进程拆分, 参考 iter_split
         :return: 分好组的明细行(没有分组信息)
         """
+        if ColumnarData.is_columnar(data):
+            return [filtered for _, _, filtered in self._iter_split_columnar(data)]
+
+        if workers is not None:
+            return [filtered for _, _, filtered in self._iter_split_parallel(data, workers)]
+
+        if self.stats is not None and self.granularity is not None:
+            return [filtered for _, _, filtered in self._iter_split_with_stats(data)]
+
         res = list()
+        router = self._make_split_router()
         for group, grouped_data in self.apply_dimensions(data):
             if grouped_data:
-                for filtered, gra in self.apply_granularity(grouped_data):
+                for filtered, gra in self.apply_granularity(grouped_data, router):
                     res.append(list(filtered))
         return res
 
-    def iter_split(self, data):
+    def iter_split(self, data, memory_limit=None, spill_dir=None, workers=None):
         """
         迭代友好的方法,
         每次都返回一个元组
+        :param data: 行数据, 或者列式数据(参考 ColumnarData), 列式数据返回的是每一组的行号
+        :param memory_limit: 流式拆分, 内存中最多保存的行数, 超出后按照维度的值哈希到固定数量的临时文件中,
+              读回时每个分区单独分组(参考 SpillPartitions), data 可以是任意的迭代器(如 iter_json_lines, iter_csv_rows),
+              数据只会被遍历一次, 内存占用与数据量以及维度值的数量无关; hash 分组时维度的顺序为分区的顺序
+        :param spill_dir: 临时文件目录, 默认使用系统的临时目录
+        :param workers: 进程数, 维度分组之后把每一组(数据很多时再按行切块)交给进程池应用粒度, 返回的顺序与单进程一致,
+              子进程只传回每个粒度满足的行号, 返回的行就是传入的行, 行数据需要可以被pickle
         :return: generator ( dimensions_info: namedtuple, Granularity: BaseCondition, grouped_data: grouped_object )
         """
+        if ColumnarData.is_columnar(data):
+            for res in self._iter_split_columnar(data):
+                yield res
+            return
+
+        if memory_limit is not None:
+            for res in self._iter_split_stream(data, memory_limit, spill_dir):
+                yield res
+            return
+
+        if workers is not None:
+            for res in self._iter_split_parallel(data, workers):
+                yield res
+            return
+
+        if self.stats is not None and self.granularity is not None:
+            for res in self._iter_split_with_stats(data):
+                yield res
+            return
+
+        router = self._make_split_router()
         for dim_info, grouped_data in self.apply_dimensions(data):
             if grouped_data:
-                for filtered, gra in self.apply_granularity(grouped_data):
+                for filtered, gra in self.apply_granularity(grouped_data, router):
                     yield dim_info, gra, filtered
 
+    def _iter_split_stream(self, data, memory_limit, spill_dir):
+        if self.granularity is None:
+            raise ValueError(u"流式拆分需要粒度")
+        if memory_limit < 1:
+            raise ValueError(u"memory_limit 至少为1")
+
+        router = self.make_router()
+        route = self._row_route(router)
+        dim_key = None if self.dimensions is None else self.dimensions.getter(*self.dimensions.fields)
+        sort = dim_key is not None and (self.group_mode or self.dimensions.group_mode) == "sorted"
+        partitions = SpillPartitions(memory_limit, spill_dir)
+        for row in data:
+            try:
+                key = None if dim_key is None else dim_key(row)
+            except KeyError:
+                raise KeyError(u"没有找到拆单维度条件")
+
+            indexes = route(key, row)
+            for index in indexes:
+                partitions.add(key, index, row)
+            if not indexes:
+                # 没有匹配任何粒度的维度值也要返回
+                partitions.add(key, None, None)
+
+        for key, buckets in partitions.iter_groups(len(router.granularities), sort):
+            dim_info = DummyDimension() if dim_key is None else self.dimensions.to_key_value(key)
+            for bucket, gra in zip(buckets, router.granularities):
+                yield dim_info, gra, bucket
+
+    def _iter_split_parallel(self, data, workers):
+        if self.granularity is None:
+            raise ValueError(u"多进程拆分需要粒度")
+        if workers < 1:
+            raise ValueError(u"workers 至少为1")
+        if self.stats is not None:
+            # 粒度在子进程中计算, 统计无法传回
+            raise ValueError(u"多进程拆分不支持统计, 请去掉 stats 或者 workers")
+
+        groups = [(dim_info, list(grouped_data)) for dim_info, grouped_data in self.apply_dimensions(data)]
+        # 每个进程大约分到4块, 只有一个分组时也可以并行
+        chunk_size = max(1, -(-sum(len(rows) for _, rows in groups) // (workers * 4)))
+        chunks, owners = list(), list()
+        for index, (_, rows) in enumerate(groups):
+            for start in range(0, len(rows), chunk_size):
+                chunks.append(rows[start:start + chunk_size])
+                owners.append(index)
+
+        # 子进程只需要粒度, 维度的getter不一定可以序列化
+        plan = SplitPlan(None, self.export_plan().granularities, self.split_mode, layout=self.layout)
+        pool = multiprocessing.Pool(workers, initializer=_init_split_worker, initargs=(plan,))
+        try:
+            merged, current = None, None
+            # imap 按照提交的顺序返回结果
+            for index, rows, offsets in zip(owners, chunks, pool.imap(_split_chunk, chunks)):
+                if index != current:
+                    if merged is not None:
+                        for res in self._merged_group(groups[current][0], merged):
+                            yield res
+                    merged, current = [list() for _ in self.granularity], index
+                for bucket, selected in zip(merged, offsets):
+                    bucket.extend(map(rows.__getitem__, selected))
+            if merged is not None:
+                for res in self._merged_group(groups[current][0], merged):
+                    yield res
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _row_route(self, router):
+        """
+        逐行拆分(流式拆分, 增量拆分)使用的路由, 统计时和 split 一样按照维度分组记录在 self.stats 中
+        :type router GranularityRouter
+        :return: function(维度的值, 行) -> 满足的粒度的下标, remains模式最多一个
+        """
+        stats = self.stats
+        first_match = self.split_mode == "remains"
+        if stats is None:
+            if not first_match:
+                indexes_of = router.indexes_of
+                return lambda key, row: indexes_of(row)
+            index_of = router.index_of
+
+            def route(key, row):
+                index = index_of(row)
+                return () if index is None else (index,)
+
+            return route
+
+        groups = dict()  # 维度的值: 与粒度一一对应的 SplitCounter
+
+        def route(key, row):
+            counters = groups.get(key)
+            if counters is None:
+                dim_info = DummyDimension() if self.dimensions is None else self.dimensions.to_key_value(key)
+                counters = groups[key] = stats.group(dim_info, router.granularities)
+            start = default_timer()
+            if first_match:
+                index = router.index_of_with_stats(row, counters)
+                indexes = () if index is None else (index,)
+            else:
+                indexes = router.indexes_of_with_stats(row, counters, stats)
+            stats.filtering_seconds += default_timer() - start
+            return indexes
+
+        return route
+
+    def _merged_group(self, dim_info, buckets):
+        for bucket, gra in zip(buckets, self.granularity):
+            yield dim_info, gra, bucket
+
     def add_dimension(self, *dim):
         """
         添加一个维度
@@ -417,31 +2192,411 @@ class OrderSplitter(object):
         :return:
         """
         if self.dimensions is None:
-            self.dimensions = Dimension(*dim)
+            self.dimensions = Dimension(*dim, group_mode=self.group_mode or "sorted")
+            if self.layout is not None:
+                self.dimensions.getter = self.layout.getter
             return
         self.dimensions.add_dimension(dim)
 
     def add_granularity(self, gra):
         """
-        添加一个粒度
+        添加一个粒度, 和构造函数一样按照粒度大小排序, 最后的 TrueCondition 始终在最后
         :param gra: 粒度对象
         :type gra BaseCondition
         :return:
         """
+        self._index = None
+        if self.layout is not None:
+            gra.bind_layout(self.layout)
         if self.granularity is None:
-            self.granularity = [gra]
+            self.granularity = [gra, TrueCondition()]
             return
         self.granularity.append(gra)
-        self.granularity.sort(key=lambda x: len(x))
+        self.granularity.sort(key=lambda x: (x.is_true_condition, len(x)))
+
+    @property
+    def index(self):
+        """
+        apply_to / full_apply_to 使用的粒度索引, 和 predicate 一样在粒度或者条件变化之后重新建立
+        :rtype GranularityIndex
+        """
+        # 条件被修改时会把使用它的索引标记为失效, 这里不用每次计算所有粒度的状态
+        if self._index is None or self._index[1].stale or self._index[0] != self.granularity:
+            self._index = (list(self.granularity), GranularityIndex(self.granularity[:-1]))
+        return self._index[1]
+
+    def rebuild_index(self):
+        self._index = None
+
+    def export_plan(self):
+        """
+        导出可以序列化的拆分计划, 参考 SplitPlan
+        :rtype SplitPlan
+        """
+        return SplitPlan.from_splitter(self)
 
     def full_apply_to(self, single):
-        """返回单条记录匹配的所有粒度"""
-        for gra in filter(lambda x: x.is_apply(single), self.granularity[:-1]):
-            yield gra
+        """返回单条记录匹配的所有粒度, 按照粒度的顺序"""
+        self._warn_unrecorded(u"full_apply_to")
+        return self.index.iter_apply_to(single)
 
     def apply_to(self, single):
-        """返回第一个匹配粒度"""
+        """返回第一个匹配粒度, 找到之后不再查找剩下的索引"""
+        self._warn_unrecorded(u"apply_to")
+        return self.index.apply_to(single)
+
+    def _warn_unrecorded(self, name):
+        if self.stats is not None:
+            # 索引只计算部分粒度, 统计不到每个粒度的结果
+            warnings.warn(u"{} 使用粒度索引, 不会记录到 stats 中".format(name), stacklevel=3)
+
+
+class _SplitGroup(object):
+    """增量拆分中一个维度分组的状态"""
+
+    __slots__ = ("seqs", "rows", "assigned", "buckets")
+
+    def __init__(self, size):
+        self.seqs = array("l")  # 每一行到达的顺序
+        self.rows = list()
+        self.assigned = array("l")  # remains模式: 每一行所属粒度的下标, -1表示没有满足的粒度
+        self.buckets = [list() for _ in range(size)]
+
+
+class IncrementalOrderSplitter(OrderSplitter):
+    """
+    增量拆单, 保存每个 (维度, 粒度) 的桶, 每次 add_batch 只路由新加入的行,
+    add_granularity / add_dimension 只重建受影响的桶, 结果和对所有行调用 split 一致
+    >>> splitter = IncrementalOrderSplitter(Dimension("type", group_mode="hash"), [Condition("age", "< 12")])
+    >>> splitter.add_batch([{"type": 1, "age": 11}, {"type": 2, "age": 13}])
+    >>> splitter.add_batch([{"type": 1, "age": 15}])
+    >>> [[row["age"] for row in bucket] for bucket in splitter.buckets()]
+    [[11], [15], [], [13]]
+    >>> splitter.add_granularity(Condition("age", "> 14"))
+    >>> [[row["age"] for row in bucket] for bucket in splitter.buckets()]
+    [[11], [15], [], [], [], [13]]
+    """
+
+    def __init__(self, dimension=None, granularities=None, split_mode="remains", group_mode=None, stats=None,
+                 layout=None):
+        super(IncrementalOrderSplitter, self).__init__(dimension, granularities, split_mode, group_mode, stats,
+                                                       layout)
+        if self.granularity is None:
+            raise ValueError(u"增量拆分需要粒度")
+        self._router = None
+        self.reset()
+
+    def reset(self):
+        """清空已经加入的行, 粒度和维度不变"""
+        self._groups = OrderedDict()  # 维度的值: _SplitGroup
+        self._seq = 0
+
+    def _key_function(self):
+        if self.dimensions is None:
+            return lambda row: None
+        getter = self.dimensions.getter(*self.dimensions.fields)
+
+        def key(row):
+            try:
+                return getter(row)
+            except KeyError:
+                raise KeyError(u"没有找到拆单维度条件")
+
+        return key
+
+    def add_batch(self, rows):
+        """路由新加入的行, 已经拆分好的行不会重新计算"""
+        if self._router is None:
+            self._router = self.make_router()
+        route, key_of = self._row_route(self._router), self._key_function()
+        first_match = self.split_mode == "remains"
+        for row in rows:
+            key = key_of(row)
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = _SplitGroup(len(self.granularity))
+            group.seqs.append(self._seq)
+            group.rows.append(row)
+            self._seq += 1
+            indexes = route(key, row)
+            if first_match:
+                group.assigned.append(indexes[0] if indexes else -1)
+            for index in indexes:
+                group.buckets[index].append(row)
+
+    def add_granularity(self, gra):
+        """
+        添加一个粒度, full模式只计算新粒度;
+        remains模式只重新计算排在第一个顺序变化的粒度之后(包括没有满足任何粒度)的行,
+        粒度排序只插入了新粒度时只需要计算新粒度, 否则用之后的粒度重新路由这些行
+        """
+        old = list(self.granularity)
+        super(IncrementalOrderSplitter, self).add_granularity(gra)
+        self._router = None
+        # 新的顺序中每个粒度在原来的下标, 新粒度为None
+        origin = [next((index for index, item in enumerate(old) if item is current), None)
+                  for current in self.granularity]
+        if self.split_mode != "remains":
+            key = gra.key_function
+            for group in self._groups.values():
+                group.buckets = [[row for row in group.rows if key(row)] if index is None else group.buckets[index]
+                                 for index in origin]
+            return
+
+        position = next(i for i, index in enumerate(origin) if index != i)
+        tail = self.granularity[position:]
+        if origin[position + 1:] == list(range(position, len(old))):
+            key = gra.key_function
+
+            def route(row, current):
+                return position if key(row) else (current if current < 0 else current + 1)
+        else:
+            router = GranularityRouter(tail)
+
+            def route(row, current):
+                index = router.index_of(row)
+                return -1 if index is None else index + position
+
+        for group in self._groups.values():
+            assigned = group.assigned
+            rebuilt = [list() for _ in tail]
+            for index, row in enumerate(group.rows):
+                current = assigned[index]
+                if 0 <= current < position:
+                    continue
+                current = assigned[index] = route(row, current)
+                if current >= 0:
+                    rebuilt[current - position].append(row)
+            group.buckets[position:] = rebuilt
+
+    def add_dimension(self, *dim):
+        """
+        添加一个维度, 现有的分组只会被拆分成更细的分组, 行所属的粒度不需要重新计算
+        """
+        super(IncrementalOrderSplitter, self).add_dimension(*dim)
+        key_of = self._key_function()
+        groups = list()
+        for group in self._groups.values():
+            split, row_keys = OrderedDict(), dict()
+            for index, row in enumerate(group.rows):
+                key = row_keys[id(row)] = key_of(row)
+                new_group = split.get(key)
+                if new_group is None:
+                    new_group = split[key] = _SplitGroup(len(self.granularity))
+                new_group.seqs.append(group.seqs[index])
+                new_group.rows.append(row)
+                if self.split_mode == "remains":
+                    new_group.assigned.append(group.assigned[index])
+            for position, bucket in enumerate(group.buckets):
+                for row in bucket:
+                    split[row_keys[id(row)]].buckets[position].append(row)
+            groups.extend(split.items())
+        # 保持维度第一次出现的顺序
+        groups.sort(key=lambda item: item[1].seqs[0])
+        self._groups = OrderedDict(groups)
+
+    def iter_buckets(self):
+        """
+        当前拆分的结果, 桶是内部保存的列表, 不要修改
+        :return: generator ( dimensions_info: namedtuple, Granularity: BaseCondition, rows: list )
+        """
+        keys = list(self._groups)
+        if self.dimensions is not None and (self.group_mode or self.dimensions.group_mode) == "sorted":
+            keys.sort()
+        for key in keys:
+            dim_info = DummyDimension() if self.dimensions is None else self.dimensions.to_key_value(key)
+            for bucket, gra in zip(self._groups[key].buckets, self.granularity):
+                yield dim_info, gra, bucket
+
+    def buckets(self):
+        """和 split 的返回值一致"""
+        return [bucket for _, _, bucket in self.iter_buckets()]
+
+    def group_keys(self):
+        """当前所有维度分组的值(getter取出的值), 按照第一次出现的顺序"""
+        return list(self._groups)
+
+    def pop_group(self, key):
+        """
+        移除一个维度分组, 之后同一个维度的数据会重新开始一个分组
+        :param key: group_keys 中的值
+        :return: [( dimensions_info: namedtuple, Granularity: BaseCondition, rows: list ), ..]
+        """
+        group = self._groups.pop(key)
+        dim_info = DummyDimension() if self.dimensions is None else self.dimensions.to_key_value(key)
+        return [(dim_info, gra, bucket) for bucket, gra in zip(group.buckets, self.granularity)]
+
+
+SPLIT_PLAN_VERSION = 2
+
+
+class SplitPlan(object):
+    """
+    可以序列化的拆分计划, 包含 规范化之后的条件, 粒度的顺序(包括采样调整之后的条件顺序), 维度的字段 以及编译后的谓词,
+    新的进程加载计划之后不需要重新排序和编译就可以直接拆分
+    编译后的谓词是marshal之后的code对象, 只在相同的python版本中使用, 否则重新编译
+    >>> splitter = OrderSplitter(Dimension("type"), [Granularity.from_dict({"age": "< 12"})])
+    >>> plan = SplitPlan.loads(splitter.export_plan().dumps())
+    >>> [[x["age"] for x in g] for g in plan.build().split([{"type": 1, "age": 11}, {"type": 1, "age": 13}])]
+    [[11], [13]]
+    """
+
+    version = SPLIT_PLAN_VERSION
+
+    def __init__(self, dimension, granularities, split_mode="remains", group_mode=None, layout=None):
+        """
+        :param dimension: (字段, getter, 分组方式) 或者 None
+        :param granularities: 排序之后的粒度, 每个粒度为 (类型, 参数, 编译后的谓词), 参考 _export_condition
+        :param layout: 记录的结构, 参考 RecordLayout
+        """
+        self.dimension = dimension
+        self.granularities = granularities
+        self.split_mode = split_mode
+        self.group_mode = group_mode
+        self.layout = layout
+        self.python_tag = self._python_tag()
+
+    @staticmethod
+    def _python_tag():
+        return platform.python_implementation(), tuple(sys.version_info[:2])
+
+    @classmethod
+    def from_splitter(cls, splitter):
+        """
+        :type splitter OrderSplitter
+        :rtype SplitPlan
+        """
+        dimension = None
+        if splitter.dimensions is not None:
+            dimension = splitter.dimensions.__getstate__()
+        granularities = None
+        if splitter.granularity is not None:
+            granularities = [cls._export_condition(gra) for gra in splitter.granularity]
+        return cls(dimension, granularities, splitter.split_mode, splitter.group_mode, getattr(splitter, "layout", None))
+
+    @classmethod
+    def _export_condition(cls, condition):
+        """
+        :return: ("true", None, None)
+                 ("condition", (字段, 条件, get_method, layout, extra), code)
+                 ("granularity", ([条件, ..], 条件的顺序, extra), code)
+        """
+        if isinstance(condition, TrueCondition):
+            return "true", None, None
+        if isinstance(condition, Condition):
+            args = condition.field, condition.condition, condition._get_method, condition.layout, dict(condition.extra)
+            return "condition", args, cls._dump_code(condition)
+        if isinstance(condition, Granularity):
+            conditions = [cls._export_condition(c) for c in condition.conditions]
+            order = condition._order[1] if condition.ordered_conditions is not condition.conditions else None
+            expression = condition.fused_expression()
+            code = None if expression is None else cls._dump_code(condition, expression)
+            return "granularity", (conditions, order, dict(condition.extra)), code
+        raise ValueError(u"拆分计划不支持的粒度: {}".format(condition))
+
+    @staticmethod
+    def _dump_code(condition, expression=None):
         try:
-            return next(self.full_apply_to(single))
-        except StopIteration:
+            return marshal.dumps(condition._compile_code(expression))
+        except SyntaxError:
             return None
+
+    def _load_condition(self, entry, load_code):
+        kind, args, code = entry
+        if kind == "true":
+            return TrueCondition()
+        if kind == "condition":
+            field, condition, get_method, layout, extra = args
+            res = Condition(field, condition, get_method, layout, **extra)
+        elif kind == "granularity":
+            conditions, order, extra = args
+            res = Granularity(*[self._load_condition(c, load_code) for c in conditions], **extra)
+            if order is not None:
+                res._order = (res._conditions_state(), tuple(order))
+        else:
+            raise ValueError(u"拆分计划不支持的粒度: {}".format(kind))
+
+        if code is not None and load_code:
+            try:
+                predicate = eval(marshal.loads(code), globals())
+            except (ValueError, EOFError, TypeError):
+                pass
+            else:
+                res._compiled = {"predicate": (res._compile_state(), predicate)}
+        return res
+
+    def build(self):
+        """
+        根据计划创建OrderSplitter, 粒度已经排好顺序, 相同python版本时直接使用编译后的谓词
+        :rtype OrderSplitter
+        """
+        dimension = None
+        if self.dimension is not None:
+            dimension = Dimension.__new__(Dimension)
+            dimension.__setstate__(self.dimension)
+        splitter = OrderSplitter(dimension, split_mode=self.split_mode, group_mode=self.group_mode)
+        splitter.layout = self.layout
+        if self.granularities is not None:
+            load_code = self.python_tag == self._python_tag()
+            splitter.granularity = [self._load_condition(entry, load_code) for entry in self.granularities]
+        return splitter
+
+    def __getstate__(self):
+        return (self.version, self.dimension, self.granularities, self.split_mode, self.group_mode, self.layout,
+                self.python_tag)
+
+    def __setstate__(self, state):
+        if state[0] != SPLIT_PLAN_VERSION:
+            raise ValueError(u"不支持的拆分计划版本: {}".format(state[0]))
+        _, self.dimension, self.granularities, self.split_mode, self.group_mode, self.layout, self.python_tag = state
+
+    def dumps(self):
+        return pickle.dumps(self, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def loads(data):
+        """:rtype SplitPlan"""
+        return pickle.loads(data)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        """:rtype SplitPlan"""
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+_worker_state = None  # 子进程中的 (是否为remains模式, GranularityRouter)
+
+
+def _init_split_worker(plan):
+    """进程池的初始化函数, 每个进程只加载一次拆分计划
+    :type plan SplitPlan
+    """
+    global _worker_state
+    splitter = plan.build()
+    _worker_state = splitter.split_mode == "remains", splitter._make_split_router()
+
+
+def _split_chunk(rows):
+    """
+    只传回行号, 行由父进程按照行号放入桶中
+    :return: 与粒度一一对应的 array, 每个粒度满足的行在 rows 中的下标
+    """
+    first_match, router = _worker_state
+    offsets = [array("l") for _ in router.granularities]
+    if first_match:
+        index_of = router.index_of
+        for offset, row in enumerate(rows):
+            index = index_of(row)
+            if index is not None:
+                offsets[index].append(offset)
+    else:
+        indexes_of = router.indexes_of
+        for offset, row in enumerate(rows):
+            for index in indexes_of(row):
+                offsets[index].append(offset)
+    return offsets
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+订单切割者的性能测试
+
+使用固定的随机种子生成订单和粒度, 测量 OrderSplitter 主要接口的 行/秒, 内存峰值 和 单行延迟,
+结果保存为json, 可以和之前保存的基准结果对比
+
+python order_splitter_benchmark.py --rows 100000 --granularities 20 --output bench.json
+python order_splitter_benchmark.py --rows 100000 --granularities 20 --baseline bench.json
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from collections import deque
+
+from order_splitter import Condition, Dimension, Granularity, OrderSplitter
+
+# 条件的类型以及默认的比例
+DEFAULT_CONDITION_MIX = {"startswith": 3, "compare": 3, "in": 2, "eq": 2}
+
+ORDER_TYPES = ("normal", "presale", "gift", "exchange", "refund")
+MEMBER_LEVELS = ("V0", "V1", "V2", "V3", "V4", "V5")
+PRODUCT_PREFIXES = ("A", "B", "C", "CX", "D", "E", "F")
+
+
+def generate_orders(rows, dimension_cardinality=10, seed=0):
+    """
+    :param rows: 订单行数
+    :param dimension_cardinality: 每个维度字段(order_type, store_code)不同值的数量
+    :return: list[dict]
+    """
+    rnd = random.Random(seed)
+    order_types = [ORDER_TYPES[i % len(ORDER_TYPES)] + str(i // len(ORDER_TYPES))
+                   for i in range(dimension_cardinality)]
+    stores = ["S{:04d}".format(i) for i in range(dimension_cardinality)]
+    return [{
+        "order_no": "O{:08d}".format(i),
+        "order_type": rnd.choice(order_types),
+        "store_code": rnd.choice(stores),
+        "product_code": rnd.choice(PRODUCT_PREFIXES) + str(rnd.randint(0, 9999)),
+        "member_level": rnd.choice(MEMBER_LEVELS),
+        "qty": rnd.randint(1, 20),
+        "price": round(rnd.uniform(1, 1000), 2),
+    } for i in range(rows)]
+
+
+def generate_granularities(count, condition_mix=None, max_conditions=3, seed=0):
+    """
+    :param count: 粒度数量
+    :param condition_mix: {条件类型: 权重}, 条件类型为 startswith, compare, in, eq
+    :param max_conditions: 每个粒度最多的条件数
+    :return: list[Granularity]
+    """
+    rnd = random.Random(seed)
+    mix = condition_mix or DEFAULT_CONDITION_MIX
+    if not any(weight > 0 for weight in mix.values()):
+        raise ValueError(u"condition_mix 至少需要一个大于0的权重: {!r}".format(mix))
+    kinds = [kind for kind, weight in sorted(mix.items()) for _ in range(weight)]
+
+    def make_condition(kind):
+        if kind == "startswith":
+            return Condition("product_code", "startswith('{}')".format(rnd.choice(PRODUCT_PREFIXES)))
+        if kind == "compare":
+            field, limit = rnd.choice((("qty", 20), ("price", 1000)))
+            return Condition(field, "{} {}".format(rnd.choice(("<", "<=", ">", ">=")), rnd.randint(1, limit)))
+        if kind == "in":
+            return Condition("member_level", "in {!r}".format(tuple(rnd.sample(MEMBER_LEVELS, 2))))
+        return Condition("member_level", "== {!r}".format(rnd.choice(MEMBER_LEVELS)))
+
+    return [Granularity(*[make_condition(rnd.choice(kinds)) for _ in range(rnd.randint(1, max_conditions))])
+            for _ in range(count)]
+
+
+def _consume(groups):
+    """迭代 iter_group / iter_split 的结果, 每一组的数据也要被迭代"""
+    for item in groups:
+        deque(item[-1], maxlen=0)
+
+
+def _measure(run, rows, repeat):
+    """
+    :param run: 无参数的函数, 执行一次被测试的操作
+    :return: 耗时最短的一次的指标
+    """
+    elapsed = min(_timed(run) for _ in range(repeat))
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "seconds": elapsed,
+        "rows_per_sec": rows / elapsed if elapsed else None,
+        "latency_us_per_row": elapsed / rows * 1e6 if rows else None,
+        "peak_memory_bytes": peak,
+    }
+
+
+def _timed(run):
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+
+def _make_splitter(granularities, split_mode):
+    return OrderSplitter(Dimension("order_type", "store_code"), list(granularities), split_mode=split_mode)
+
+
+def run_benchmarks(rows=100000, dimension_cardinality=10, granularities=20, condition_mix=None,
+                   apply_to_rows=10000, repeat=3, seed=0):
+    """
+    :return: {"params": 参数, "results": {场景: 指标}}
+    """
+    for name, value in (("rows", rows), ("dimension_cardinality", dimension_cardinality),
+                        ("granularities", granularities), ("apply_to_rows", apply_to_rows), ("repeat", repeat)):
+        if value < 1:
+            raise ValueError(u"{} 至少为1: {}".format(name, value))
+    orders = generate_orders(rows, dimension_cardinality, seed)
+    granularity_list = generate_granularities(granularities, condition_mix, seed=seed)
+    dimension = Dimension("order_type", "store_code")
+    results = dict()
+
+    results["Dimension.iter_group"] = _measure(
+        lambda: _consume(dimension.iter_group(orders)), rows, repeat)
+    results["Granularity.apply"] = _measure(
+        lambda: [list(part) for part in granularity_list[0].apply(orders)], rows, repeat)
+
+    for split_mode in ("remains", "full"):
+        splitter = _make_splitter(granularity_list, split_mode)
+        results["OrderSplitter.split[{}]".format(split_mode)] = _measure(
+            lambda: splitter.split(orders), rows, repeat)
+        results["OrderSplitter.iter_split[{}]".format(split_mode)] = _measure(
+            lambda: _consume(splitter.iter_split(orders)), rows, repeat)
+
+    splitter = _make_splitter(granularity_list, "remains")
+    sample = orders[:apply_to_rows]
+    results["OrderSplitter.apply_to"] = _measure(
+        lambda: [splitter.apply_to(order) for order in sample], len(sample), repeat)
+
+    return {
+        "params": {
+            "rows": rows,
+            "dimension_cardinality": dimension_cardinality,
+            "granularities": granularities,
+            "condition_mix": condition_mix or DEFAULT_CONDITION_MIX,
+            "apply_to_rows": apply_to_rows,
+            "repeat": repeat,
+            "seed": seed,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+
+
+def compare(current, baseline, tolerance=0.1):
+    """
+    对比 rows_per_sec, 低于基准 (1 - tolerance) 的场景视为性能下降
+    :return: [(场景, 当前, 基准, 比例, 是否下降)]
+    """
+    res = list()
+    for name, metrics in sorted(current["results"].items()):
+        base = baseline.get("results", {}).get(name)
+        if not base or not base.get("rows_per_sec") or not metrics.get("rows_per_sec"):
+            continue
+        ratio = metrics["rows_per_sec"] / base["rows_per_sec"]
+        res.append((name, metrics["rows_per_sec"], base["rows_per_sec"], ratio, ratio < 1 - tolerance))
+    return res
+
+
+def _positive_int(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(u"至少为1: {}".format(text))
+    return value
+
+
+def _condition_mix(text):
+    """{条件类型: 权重}, 权重为非负整数, 至少一个大于0"""
+    try:
+        mix = json.loads(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(u"不是json: {}".format(text))
+    if not isinstance(mix, dict) or not mix:
+        raise argparse.ArgumentTypeError(u"需要 {{条件类型: 权重}}: {}".format(text))
+    for kind, weight in mix.items():
+        if kind not in DEFAULT_CONDITION_MIX:
+            raise argparse.ArgumentTypeError(u"未知的条件类型 {}, 可选: {}".format(
+                kind, ", ".join(sorted(DEFAULT_CONDITION_MIX))))
+        if not isinstance(weight, int) or isinstance(weight, bool) or weight < 0:
+            raise argparse.ArgumentTypeError(u"权重需要是非负整数: {}={!r}".format(kind, weight))
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError(u"至少需要一个大于0的权重: {}".format(text))
+    return mix
+
+
+def _format_metric(value, spec):
+    """耗时为0等情况下指标为None, 显示为 -"""
+    return "-" if value is None else format(value, spec)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=u"order_splitter 性能测试")
+    parser.add_argument("--rows", type=_positive_int, default=100000)
+    parser.add_argument("--dimension-cardinality", type=_positive_int, default=10)
+    parser.add_argument("--granularities", type=_positive_int, default=20)
+    parser.add_argument("--condition-mix", type=_condition_mix, default=None,
+                        help=u'条件比例, 如 \'{"startswith": 1, "compare": 1, "in": 0, "eq": 0}\'')
+    parser.add_argument("--apply-to-rows", type=_positive_int, default=10000)
+    parser.add_argument("--repeat", type=_positive_int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help=u"保存结果的json文件")
+    parser.add_argument("--baseline", help=u"对比的基准结果json文件")
+    parser.add_argument("--tolerance", type=float, default=0.1, help=u"允许的性能下降比例")
+    args = parser.parse_args(argv)
+
+    result = run_benchmarks(args.rows, args.dimension_cardinality, args.granularities, args.condition_mix,
+                            args.apply_to_rows, args.repeat, args.seed)
+    for name, metrics in sorted(result["results"].items()):
+        print("{:<40} {:>14} rows/s {:>10} us/row {:>12,} bytes".format(
+            name, _format_metric(metrics["rows_per_sec"], ",.0f"),
+            _format_metric(metrics["latency_us_per_row"], ".2f"), metrics["peak_memory_bytes"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressed = False
+        print("")
+        for name, current, base, ratio, slower in compare(result, baseline, args.tolerance):
+            regressed = regressed or slower
+            print("{:<40} {:>8.2f}x {}".format(name, ratio, "REGRESSION" if slower else ""))
+        return 1 if regressed else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+共享内存中的只读 MappingList
+
+主进程把 MappingList (或者任意的 key-value) 写入一块 multiprocessing.shared_memory, 子进程通过名字直接使用,
+不需要反序列化整张表; 对象本身被pickle时只传递名字, 可以直接作为进程池任务的参数
+
+    with SharedMappingList.create(mapping_list) as table:
+        pool.map(work, [(table, order) for order in orders])
+
+结构: 头部 | 条目(key和value的位置) | 开放寻址的哈希表(条目的下标) | key和value的数据
+key 使用固定的编码比较(str/int/bytes, 其他类型使用pickle), 因此 1 和 1.0 是不同的key; value 在读取时才反序列化
+"""
+import pickle
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from collections.abc import ItemsView, KeysView, Mapping, ValuesView
+from multiprocessing import resource_tracker, shared_memory
+
+_MAGIC = b"SMLIST01"
+_header = struct.Struct("<8sQQQQ")  # magic, 条目数, 哈希表大小, 条目的位置, 哈希表的位置
+_entry = struct.Struct("<QQIII4x")  # key位置, value位置, key长度, value长度, key的哈希
+_slot = struct.Struct("<q")
+_PROTOCOL = 4
+
+
+def _encode_key(key):
+    key_type = type(key)
+    if key_type is str:
+        return b"s" + key.encode("utf-8", "surrogatepass")
+    if key_type is int:
+        return b"i" + str(key).encode("ascii")
+    if key_type is bytes:
+        return b"b" + key
+    return b"p" + pickle.dumps(key, _PROTOCOL)
+
+
+def _decode_key(data):
+    kind, data = data[:1], data[1:]
+    if kind == b"s":
+        return data.decode("utf-8", "surrogatepass")
+    if kind == b"i":
+        return int(data)
+    if kind == b"b":
+        return data
+    return pickle.loads(data)
+
+
+def _hash(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+_register_lock = threading.Lock()
+
+
+def _attach(name):
+    try:  # python3.13+
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # 之前的版本打开已有的共享内存也会注册到 resource_tracker, 进程退出时可能删除还在使用的共享内存,
+    # 只有创建者负责释放, 因此打开时跳过注册
+    with _register_lock:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class SharedMappingList(object):
+    """
+    只读的 MappingList, 和 MappingList 一样迭代时返回value, 下标访问返回第几个value
+    >>> from _collection import MappingList
+    >>> table = SharedMappingList.create(MappingList(a=1, b=[2]))
+    >>> reader = SharedMappingList.attach(table.name)
+    >>> reader.get("b"), reader.get("c"), list(reader), dict(reader.items())
+    ([2], None, [1, [2]], {'a': 1, 'b': [2]})
+    >>> reader.close()
+    >>> table.unlink()
+    """
+
+    def __init__(self, shm, owner=False):
+        """使用 create 或者 attach 创建"""
+        self._shm = shm
+        self._owner = owner
+        self._buf = shm.buf
+        self._table = None
+        magic, self._count, self._table_size, self._entries_offset, table_offset = _header.unpack_from(self._buf)
+        if magic != _MAGIC:
+            self.close()
+            raise ValueError(u"{} 不是 SharedMappingList".format(shm.name))
+        self._table = self._buf[table_offset:table_offset + self._table_size * _slot.size].cast("q")
+
+    @classmethod
+    def create(cls, data, name=None):
+        """
+        把数据写入新的共享内存, 返回的对象负责 unlink
+        :param data: MappingList, 字典, 或者 (key, value) 的可迭代对象, 重复的key保留第一次的位置和最后一次的值
+        :param name: 共享内存的名字, 不传则随机生成
+        :rtype SharedMappingList
+        """
+        pairs = data.items() if hasattr(data, "items") else data
+        encoded = OrderedDict()
+        for key, value in pairs:
+            encoded[_encode_key(key)] = pickle.dumps(value, _PROTOCOL)
+
+        count = len(encoded)
+        table_size = 8
+        while table_size < count * 2:
+            table_size *= 2
+        entries_offset = _header.size
+        table_offset = entries_offset + count * _entry.size
+        data_offset = table_offset + table_size * _slot.size
+        total = data_offset + sum(len(k) + len(v) for k, v in encoded.items())
+
+        shm = shared_memory.SharedMemory(name=name, create=True, size=max(total, 1))
+        try:
+            buf = shm.buf
+            _header.pack_into(buf, 0, _MAGIC, count, table_size, entries_offset, table_offset)
+            slots = [-1] * table_size
+            offset = data_offset
+            for index, (key, value) in enumerate(encoded.items()):
+                key_hash = _hash(key)
+                buf[offset:offset + len(key)] = key
+                buf[offset + len(key):offset + len(key) + len(value)] = value
+                _entry.pack_into(buf, entries_offset + index * _entry.size,
+                                 offset, offset + len(key), len(key), len(value), key_hash)
+                offset += len(key) + len(value)
+                slot = key_hash & (table_size - 1)
+                while slots[slot] != -1:
+                    slot = (slot + 1) & (table_size - 1)
+                slots[slot] = index
+            struct.pack_into("<{}q".format(table_size), buf, table_offset, *slots)
+            del buf
+        except Exception:
+            shm.close()
+            shm.unlink()
+            raise
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """
+        通过名字使用已经创建的共享内存
+        :rtype SharedMappingList
+        """
+        return cls(_attach(name))
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def __reduce__(self):
+        return self.attach, (self.name,)
+
+    def _entry_at(self, index):
+        return _entry.unpack_from(self._buf, self._entries_offset + index * _entry.size)
+
+    def _find(self, key):
+        """:return: 条目的下标, 不存在时为-1"""
+        encoded = _encode_key(key)
+        key_hash, mask = _hash(encoded), self._table_size - 1
+        slot = key_hash & mask
+        while True:
+            index = self._table[slot]
+            if index == -1:
+                return -1
+            key_offset, _, key_len, _, entry_hash = self._entry_at(index)
+            if entry_hash == key_hash and key_len == len(encoded) \
+                    and self._buf[key_offset:key_offset + key_len] == encoded:
+                return index
+            slot = (slot + 1) & mask
+
+    def _value_at(self, index):
+        _, value_offset, _, value_len, _ = self._entry_at(index)
+        return pickle.loads(self._buf[value_offset:value_offset + value_len])
+
+    def _key_at(self, index):
+        key_offset, _, key_len, _, _ = self._entry_at(index)
+        return _decode_key(bytes(self._buf[key_offset:key_offset + key_len]))
+
+    def get(self, key, default=None):
+        index = self._find(key)
+        return default if index == -1 else self._value_at(index)
+
+    def force_get(self, key):
+        """
+        raise keyError when the key don't exit
+        """
+        index = self._find(key)
+        if index == -1:
+            raise KeyError(key)
+        return self._value_at(index)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("SharedMappingList index out of range")
+        return self._value_at(index)
+
+    def __iter__(self):
+        return (self._value_at(index) for index in range(self._count))
+
+    def _iter_keys(self):
+        return (self._key_at(index) for index in range(self._count))
+
+    def _iter_items(self):
+        return ((self._key_at(index), self._value_at(index)) for index in range(self._count))
+
+    def as_mapping(self):
+        """只读的字典视图, 不复制数据"""
+        return SharedMappingProxy(self)
+
+    def keys(self):
+        return self.as_mapping().keys()
+
+    def values(self):
+        return self.as_mapping().values()
+
+    def items(self):
+        return self.as_mapping().items()
+
+    def to_dict(self):
+        return OrderedDict(self._iter_items())
+
+    def close(self):
+        """释放当前进程的映射, 共享内存本身由创建者 unlink"""
+        if self._shm is None:
+            return
+        if self._table is not None:
+            self._table.release()
+            self._table = None
+        self._buf = None
+        self._shm.close()
+        self._shm = None
+
+    def unlink(self):
+        """关闭并删除共享内存, 只有创建者可以调用"""
+        if not self._owner:
+            raise ValueError(u"只有创建者可以删除共享内存")
+        shm = self._shm
+        self.close()
+        if shm is not None:
+            shm.unlink()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._owner:
+            self.unlink()
+        else:
+            self.close()
+
+
+class SharedMappingProxy(Mapping):
+    """SharedMappingList 的字典视图"""
+    __slots__ = ("_list",)
+
+    def __init__(self, shared_list):
+        self._list = shared_list
+
+    def __getitem__(self, key):
+        return self._list.force_get(key)
+
+    def __iter__(self):
+        return self._list._iter_keys()
+
+    def __len__(self):
+        return len(self._list)
+
+    def __contains__(self, key):
+        return self._list._find(key) != -1
+
+    def keys(self):
+        return KeysView(self)
+
+    def values(self):
+        return _ValuesView(self)
+
+    def items(self):
+        return _ItemsView(self)
+
+
+class _ValuesView(ValuesView):
+    def __iter__(self):
+        return iter(self._mapping._list)
+
+
+class _ItemsView(ItemsView):
+    def __iter__(self):
+        return self._mapping._list._iter_items()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+批量生成 INSERT 语句
+
+按照 chunk_size 把多行数据合并成一条 INSERT ... VALUES (...), (...), 或者生成参数化的sql以及参数,
+行可以是 dict, NullDict 或者 MappingList, None(以及NullDict中的'null')作为NULL
+
+    builder = BatchInsertBuilder("order_line", ["order_no", "sku", "qty"], chunk_size=1000)
+    for sql in builder.iter_statements(rows):
+        cursor.execute(sql)
+    for sql, params in builder.iter_executemany(rows):
+        cursor.executemany(sql, params)
+"""
+import datetime
+import decimal
+import math
+from itertools import islice
+from operator import itemgetter
+
+from _collection import MappingList, NullDict
+
+try:
+    text_type, binary_type, integer_types = unicode, str, (int, long)  # python2
+except NameError:
+    text_type, binary_type, integer_types = str, bytes, (int,)
+
+
+def _quote_text(value, backslash_escapes):
+    if backslash_escapes:
+        value = value.replace("\\", "\\\\")
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _float_literal(value):
+    """NaN(比如pandas的缺失值)作为NULL, sql没有无穷大的字面量"""
+    if math.isnan(value):
+        return "NULL"
+    if math.isinf(value):
+        raise ValueError(u"无法转换为sql字面量: {0!r}".format(value))
+    return repr(value)
+
+
+def _decimal_literal(value):
+    if value.is_nan():
+        return "NULL"
+    if value.is_infinite():
+        raise ValueError(u"无法转换为sql字面量: {0!r}".format(value))
+    return str(value)
+
+
+class BatchInsertBuilder(object):
+    """
+    >>> builder = BatchInsertBuilder("t", chunk_size=2)
+    >>> rows = [{"a": 1, "b": "x'y"}, NullDict(a=2, b=None), {"a": None}]
+    >>> list(builder.iter_statements(rows))
+    ["INSERT INTO `t` (`a`, `b`) VALUES (1, 'x''y'), (2, NULL)", 'INSERT INTO `t` (`a`, `b`) VALUES (NULL, NULL)']
+    >>> list(builder.iter_executemany(rows))[0]
+    ('INSERT INTO `t` (`a`, `b`) VALUES (%s, %s)', [(1, "x'y"), (2, None)])
+    >>> builder.literal(float("nan")), builder.literal(decimal.Decimal("NaN")), builder.literal(0.1)
+    ('NULL', 'NULL', '0.1')
+    >>> builder.literal(float("-inf"))
+    Traceback (most recent call last):
+    ...
+    ValueError: 无法转换为sql字面量: -inf
+    """
+
+    def __init__(self, table, columns=None, chunk_size=1000, placeholder="%s", quote="`", backslash_escapes=True,
+                 statement="INSERT"):
+        """
+        :param table: 表名
+        :param columns: 列名, 不传则使用第一行的key
+        :param chunk_size: 每条语句(或者每组参数)的行数
+        :param placeholder: 参数化sql的占位符, 和数据库驱动的paramstyle一致, 如 %s, ?
+        :param quote: 表名和列名的引号, mysql为`, 标准sql为"
+        :param backslash_escapes: 字符串中的反斜杠是否需要转义(mysql默认需要)
+        :param statement: INSERT, INSERT IGNORE, REPLACE 等
+        """
+        if chunk_size < 1:
+            raise ValueError(u"chunk_size 至少为1")
+        self.table = table
+        self.columns = None if columns is None else list(columns)
+        self.chunk_size = chunk_size
+        self.placeholder = placeholder
+        self.quote = quote
+        self.backslash_escapes = backslash_escapes
+        self.statement = statement
+        self._formatters = {
+            type(None): lambda value: "NULL",
+            bool: lambda value: "1" if value else "0",
+            float: _float_literal,
+            decimal.Decimal: _decimal_literal,
+            text_type: lambda value: _quote_text(value, self.backslash_escapes),
+            datetime.datetime: lambda value: "'" + value.isoformat(" ") + "'",
+            datetime.date: lambda value: "'" + value.isoformat() + "'",
+        }
+        for integer_type in integer_types:
+            # int.__repr__ 对 IntEnum 等子类也是数字, python2的long使用str避免L后缀
+            self._formatters[integer_type] = int.__repr__ if integer_type is int else str
+        if binary_type is bytes:
+            self._formatters[bytes] = lambda value: "X'" + value.hex() + "'"
+
+    def quote_identifier(self, name):
+        return "{0}{1}{0}".format(self.quote, name.replace(self.quote, self.quote * 2)) if self.quote else name
+
+    def literal(self, value):
+        """把python的值转换为sql的字面量"""
+        formatter = self._formatters.get(type(value))
+        if formatter is not None:
+            return formatter(value)
+        for value_type, formatter in self._formatters.items():
+            if isinstance(value, value_type):
+                return formatter(value)
+        return _quote_text(text_type(value), self.backslash_escapes)
+
+    def _head(self, columns):
+        return "{0} INTO {1} ({2}) VALUES ".format(self.statement, self.quote_identifier(self.table),
+                                                   ", ".join(self.quote_identifier(c) for c in columns))
+
+    def _iter_chunks(self, rows):
+        """
+        :return: generator (列名, [每一行的值tuple, ..])
+        """
+        rows = iter(rows)
+        columns = self.columns
+        if columns is None:
+            try:
+                first = next(rows)
+            except StopIteration:
+                return
+            columns = list(first.keys())
+            rows = _chain_first(first, rows)
+        values_of = self._row_values(columns)
+        while True:
+            chunk = [values_of(row) for row in islice(rows, self.chunk_size)]
+            if not chunk:
+                return
+            yield columns, chunk
+
+    @staticmethod
+    def _row_values(columns):
+        """每一行的值, 缺少的列为None, NullDict中的'null'为None"""
+        getter = itemgetter(*columns)
+        single = len(columns) == 1
+
+        def values_of(row):
+            if isinstance(row, MappingList):
+                values = tuple(row.get(column) for column in columns)
+            else:
+                try:
+                    values = (getter(row),) if single else getter(row)
+                except KeyError:
+                    values = tuple(row.get(column) for column in columns)
+            if isinstance(row, NullDict) and "null" in values:
+                values = tuple(None if value == "null" else value for value in values)
+            return values
+
+        return values_of
+
+    def iter_statements(self, rows):
+        """
+        每 chunk_size 行生成一条带有字面量的 INSERT 语句
+        :param rows: 可迭代的 dict / NullDict / MappingList
+        :return: generator str
+        """
+        literal = self.literal
+        for columns, chunk in self._iter_chunks(rows):
+            yield self._head(columns) + ", ".join(
+                "(" + ", ".join([literal(value) for value in values]) + ")" for values in chunk)
+
+    def iter_executemany(self, rows):
+        """
+        单行的参数化sql以及每 chunk_size 行的参数, 用于 cursor.executemany
+        :return: generator (sql, [tuple, ..])
+        """
+        sql = None
+        for columns, chunk in self._iter_chunks(rows):
+            if sql is None:
+                sql = self._head(columns) + "(" + ", ".join([self.placeholder] * len(columns)) + ")"
+            yield sql, chunk
+
+    def iter_parameterized(self, rows):
+        """
+        每 chunk_size 行生成一条多行的参数化sql以及展开的参数, 用于 cursor.execute
+        :return: generator (sql, tuple)
+        """
+        row_placeholder = None
+        for columns, chunk in self._iter_chunks(rows):
+            if row_placeholder is None:
+                row_placeholder = "(" + ", ".join([self.placeholder] * len(columns)) + ")"
+            params = tuple(value for values in chunk for value in values)
+            yield self._head(columns) + ", ".join([row_placeholder] * len(chunk)), params
+
+
+def _chain_first(first, rows):
+    yield first
+    for row in rows:
+        yield row